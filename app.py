@@ -1,12 +1,19 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
-from scheduler import ShiftScheduler, Employee, Shift
+from scheduler import ShiftScheduler, Employee, Shift, DAILY_SHIFT_TYPES
 import io
+import os
 import json
 import plotly.express as px
+import xlsxwriter
 import plotly.graph_objects as go
 from license_manager import LicenseManager
+from schedule_cache import ScheduleCache
+from export_manager import ExportManager, build_zip
+from demand_reader import read_demand
+import schedule_export
 
 # Настройка страницы
 st.set_page_config(
@@ -69,7 +76,21 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Инициализация license manager
-license_manager = LicenseManager()
+@st.cache_resource
+def get_license_manager():
+    """Один менеджер лицензий на процесс: кэш проверок общий для перезапусков и сессий"""
+    return LicenseManager()
+
+license_manager = get_license_manager()
+
+@st.cache_resource
+def get_schedule_cache():
+    """Общий для всех сессий кэш готовых расписаний
+    
+    SCHEDULE_CACHE_DIR - каталог для сохранения кэша между перезапусками (по умолчанию только память)
+    """
+    return ScheduleCache(max_entries=32, max_bytes=64 * 1024 * 1024,
+                         persist_dir=os.environ.get("SCHEDULE_CACHE_DIR") or None)
 
 # Инициализация session state
 if 'scheduler' not in st.session_state:
@@ -86,9 +107,17 @@ if 'license_data' not in st.session_state:
     st.session_state.license_data = None
 if 'session_id' not in st.session_state:
     st.session_state.session_id = None
+if 'solver_report' not in st.session_state:
+    st.session_state.solver_report = None
+if 'improve_report' not in st.session_state:
+    st.session_state.improve_report = None
+if 'demand_report' not in st.session_state:
+    st.session_state.demand_report = None
+if 'demand_upload_key' not in st.session_state:
+    st.session_state.demand_upload_key = None
 
-def parse_date_list(date_string: str):
-    """Парсинг списка дат из строки"""
+def parse_date_list(date_string: str, warn: bool = True):
+    """Парсинг списка дат из строки (warn=False - неверные даты пропускаются молча)"""
     dates = []
     if not date_string.strip():
         return dates
@@ -100,118 +129,150 @@ def parse_date_list(date_string: str):
                 date = datetime.strptime(date_str, "%d.%m.%Y")
                 dates.append(date)
             except ValueError:
-                st.warning(f"Неверный формат даты: {date_str}. Используйте ДД.ММ.ГГГГ")
+                if warn:
+                    st.warning(f"Неверный формат даты: {date_str}. Используйте ДД.ММ.ГГГГ")
     return dates
 
 def read_schedule_from_csv(uploaded_file):
-    """Чтение расписания из загруженного CSV файла"""
-    daily_shifts = {}
+    """Чтение расписания из загруженного файла (CSV или XLSX)
     
+    Возвращает наряды по датам и отчет об ошибочных строках (None при ошибке чтения).
+    """
     try:
-        # Читаем файл с учетом BOM
-        content = uploaded_file.read().decode('utf-8-sig')
-        lines = content.strip().split('\n')
-        
-        # Пропускаем заголовок
-        for line in lines[1:]:
-            if not line.strip():
-                continue
-                
-            parts = line.split(';')
-            if len(parts) < 2:
-                continue
-            
-            date_str = parts[0].strip()
-            shifts_str = parts[1].strip()
-            
-            try:
-                date = datetime.strptime(date_str, "%d.%m.%Y")
-                shift_types = []
-                
-                if shifts_str:
-                    for shift_str in shifts_str.split(','):
-                        shift_type = int(shift_str.strip())
-                        if 1 <= shift_type <= 7:
-                            shift_types.append(shift_type)
-                
-                daily_shifts[date] = shift_types
-                
-            except ValueError:
-                continue
-        
-        return daily_shifts
-        
+        return read_demand(uploaded_file, uploaded_file.name)
     except Exception as e:
         st.error(f"Ошибка чтения файла: {e}")
-        return {}
+        return {}, None
+
+def show_demand_report(report):
+    """Ошибочные значения и объединенные даты загруженного расписания"""
+    if report is None:
+        return
+    if report.error_count:
+        with st.expander(f"⚠️ Пропущено ошибочных значений: {report.error_count}"):
+            errors_df = pd.DataFrame(report.errors, columns=['Строка', 'Ошибка'])
+            st.dataframe(errors_df, use_container_width=True, hide_index=True)
+            if report.error_count > len(report.errors):
+                st.caption(f"Показаны первые {len(report.errors)} ошибок")
+    if report.duplicate_dates:
+        st.info(f"Строки с повторяющимися датами объединены: {report.duplicate_dates}")
+    if report.ignored_cells:
+        st.info(f"Пропущено ячеек после списка нарядов (например, комментариев): {report.ignored_cells}")
+
+def build_scheduler(employees_data, warn: bool = True):
+    """Создание планировщика со списком сотрудников (без генерации)"""
+    scheduler = ShiftScheduler()
+    for emp_data in employees_data:
+        if emp_data['name'].strip():
+            scheduler.add_employee(
+                emp_data['name'].strip(),
+                parse_date_list(emp_data['vacation'], warn),
+                parse_date_list(emp_data['exclusion'], warn),
+                emp_data.get('priority', 0)
+            )
+    return scheduler
+
+def find_changed_constraints(scheduler, employees_data):
+    """Сотрудники расписания, у которых в боковой панели изменились отпуск или нежелательные даты"""
+    changed = []
+    for emp_data in employees_data:
+        employee = scheduler.employee_by_name.get(emp_data['name'].strip())
+        if employee is None:
+            continue
+        vacation_days = parse_date_list(emp_data['vacation'])
+        exclusion_days = parse_date_list(emp_data['exclusion'])
+        if ({day.toordinal() for day in vacation_days} != employee.vacation_ordinals or
+                {day.toordinal() for day in exclusion_days} != employee.exclusion_ordinals):
+            changed.append((employee, vacation_days, exclusion_days))
+    return changed
 
 def create_calendar_table(scheduler, daily_shifts):
-    """Создание календарной таблицы для отображения"""
+    """Создание календарной таблицы для отображения
+    
+    Таблица строится одной сводкой (pivot) нарядов по сотрудникам и дням
+    с наложением маски отпусков, без перебора всех нарядов для каждой ячейки.
+    """
     if not daily_shifts:
         return None
     
-    # Получаем все даты
-    dates = sorted(daily_shifts.keys())
-    all_dates = set()
-    for date in dates:
-        all_dates.add(date)
-        if any(s.type in [1, 2, 3, 4, 5, 6] for s in scheduler.assigned_shifts if s.date == date):
-            all_dates.add(date + timedelta(days=1))
+    employees = scheduler.employees
+    if not employees:
+        return pd.DataFrame()
     
-    all_dates = sorted(all_dates)
+    employee_rows = {employee.id: row for row, employee in enumerate(employees)}
+    shifts = scheduler.assigned_shifts
+    shift_rows = np.array([employee_rows[shift.employee_id] for shift in shifts], dtype=np.int64)
+    shift_days = np.array([shift.day for shift in shifts], dtype=np.int64)
+    shift_types = np.array([shift.type for shift in shifts], dtype=np.int64)
+    is_daily = np.isin(shift_types, list(DAILY_SHIFT_TYPES))
     
-    # Создаем DataFrame
-    data = []
-    for employee in scheduler.employees:
-        row = {'ФИО': employee.name}
-        
-        for date in all_dates:
-            cell = ''
-            
-            # Проверяем отпуск
-            if any(vacation.date() == date.date() for vacation in employee.vacation_days):
-                cell = 'Х'
-            else:
-                # Ищем наряды
-                for shift in scheduler.assigned_shifts:
-                    if shift.employee_id == employee.id:
-                        shift_days = [shift.date, shift.date + timedelta(days=1)] if shift.type in [1,2,3,4,5,6] else [shift.date]
-                        if date in shift_days:
-                            if shift.date == date:
-                                cell = str(shift.type)
-                            else:
-                                cell = '*'
-                            break
-            
-            row[date.strftime('%d.%m')] = cell
-        
-        # Добавляем статистику
-        row['Итого'] = scheduler.employee_stats[employee.id]['shifts_count']
-        row['Осталось слотов'] = scheduler.employee_stats[employee.id]['monthly_slots']
-        
-        data.append(row)
+    # Даты: все дни расписания и следующий день после назначенных суточных нарядов
+    schedule_days = np.array([date.toordinal() for date in daily_shifts], dtype=np.int64)
+    all_days = np.union1d(schedule_days, shift_days[is_daily] + 1)
     
-    df = pd.DataFrame(data)
-    return df
-
-def export_to_csv(scheduler, daily_shifts):
-    """Экспорт результатов в CSV"""
-    # Создаем таблицу распределения
-    df = create_calendar_table(scheduler, daily_shifts)
+    # Ячейки нарядов: номер в день заступления, * на следующий день после суточного.
+    # Порядок строк повторяет порядок нарядов, при совпадении ячеек берется первая
+    order = np.argsort(np.concatenate([
+        np.arange(len(shifts)) * 2,
+        np.flatnonzero(is_daily) * 2 + 1
+    ]), kind='stable')
+    cells = pd.DataFrame({
+        'row': np.concatenate([shift_rows, shift_rows[is_daily]])[order],
+        'day': np.concatenate([shift_days, shift_days[is_daily] + 1])[order],
+        'cell': np.concatenate([shift_types.astype(str), np.full(is_daily.sum(), '*')])[order].astype(object)
+    }).drop_duplicates(['row', 'day'])
+    
+    grid = (
+        cells.pivot(index='row', columns='day', values='cell')
+        .reindex(index=range(len(employees)), columns=all_days)
+        .fillna('')
+        .to_numpy(dtype=object, copy=True)  # копия: в pandas 3 возможен вид только для чтения
+    )
+    
+    # Маска отпусков поверх нарядов
+    day_columns = {day: col for col, day in enumerate(all_days.tolist())}
+    vacation_rows, vacation_cols = [], []
+    for row, employee in enumerate(employees):
+        for day in employee.vacation_ordinals:
+            col = day_columns.get(day)
+            if col is not None:
+                vacation_rows.append(row)
+                vacation_cols.append(col)
+    grid[vacation_rows, vacation_cols] = 'Х'
+    
+    data = {'ФИО': [employee.name for employee in employees]}
+    for col, day in enumerate(all_days.tolist()):
+        data[datetime.fromordinal(day).strftime('%d.%m')] = grid[:, col].tolist()
     
-    # Создаем файл с нераспределенными нарядами
+    # Добавляем статистику
+    data['Итого'] = [scheduler.employee_stats[employee.id]['shifts_count'] for employee in employees]
+    data['Осталось слотов'] = [scheduler.employee_stats[employee.id]['monthly_slots'] for employee in employees]
+    
+    return pd.DataFrame(data)
+
+# Столбцы таблицы нераспределенных нарядов
+UNASSIGNED_COLUMNS = ['Дата', 'Тип наряда', 'Дни', 'Причина', 'В отпуске', 'Лимит', 'Заняты', 'Нежелательная дата']
+UNASSIGNED_CSV_COLUMNS = ['Дата', 'Тип наряда', 'Причина']
+UNASSIGNED_EXCEL_COLUMNS = ['Дата', 'Тип наряда', 'Дни', 'Причина']
+
+def create_unassigned_table(scheduler):
+    """Таблица нераспределенных нарядов с причинами и числом заблокированных сотрудников"""
     unassigned_data = []
     for shift in scheduler.unassigned_shifts:
-        reason = scheduler.analyze_unassigned_reason(shift)
+        reason = scheduler.get_unassigned_reason(shift)
+        blockers = scheduler.unassigned_reasons.get(shift, {})
         unassigned_data.append({
             'Дата': shift.date.strftime('%d.%m.%Y'),
             'Тип наряда': shift.type,
-            'Причина': reason
+            'Дни': '2 дня (с отдыхом)' if shift.type in [1,2,3,4,5,6] else '8 часов',
+            'Причина': reason,
+            'В отпуске': blockers.get('vacation'),
+            'Лимит': blockers.get('limit'),
+            'Заняты': blockers.get('busy'),
+            'Нежелательная дата': blockers.get('exclusion')
         })
     
-    unassigned_df = pd.DataFrame(unassigned_data)
-    
-    return df, unassigned_df
+    return pd.DataFrame(unassigned_data, columns=UNASSIGNED_COLUMNS)
 
 def save_employees_profile(employees_data):
     """Сохранение профиля сотрудников в JSON"""
@@ -279,7 +340,7 @@ def create_daily_distribution_chart(scheduler, daily_shifts):
     
     daily_counts = []
     for date in dates:
-        assigned_count = sum(1 for shift in scheduler.assigned_shifts if shift.date == date)
+        assigned_count = sum(1 for shift in scheduler.shifts_by_date.get(date, []) if shift.employee_id is not None)
         total_count = len(daily_shifts[date])
         daily_counts.append({
             'Дата': date.strftime('%d.%m'),
@@ -306,8 +367,7 @@ def create_employee_timeline(scheduler, daily_shifts):
     data = []
     
     for employee in scheduler.employees:
-        employee_shifts = [s for s in scheduler.assigned_shifts if s.employee_id == employee.id]
-        for shift in employee_shifts:
+        for shift in scheduler.shifts_by_employee[employee.id]:
             start_date = shift.date
             if shift.type in [1, 2, 3, 4, 5, 6]:
                 end_date = shift.date + timedelta(days=2)
@@ -337,107 +397,165 @@ def create_employee_timeline(scheduler, daily_shifts):
         return fig
     return None
 
-def export_to_excel(scheduler, daily_shifts):
-    """Экспорт результатов в Excel с форматированием"""
+def create_stats_table(scheduler):
+    """Таблица нагрузки по сотрудникам"""
+    stats_data = []
+    for employee in scheduler.employees:
+        stats_data.append({
+            'Сотрудник': employee.name,
+            'Приоритет': employee.priority,
+            'Нарядов': scheduler.employee_stats[employee.id]['shifts_count'],
+            'Осталось слотов': scheduler.employee_stats[employee.id]['monthly_slots'],
+            'Занято дней': len(scheduler.employee_stats[employee.id]['occupied_days'])
+        })
+    
+    return pd.DataFrame(stats_data)
+
+def build_excel_report(df, stats_df, unassigned_df):
+    """Excel-отчет из готовых таблиц (календарь, статистика, нераспределенные)
+    
+    Не обращается к планировщику, поэтому может выполняться в фоновом потоке.
+    Книга пишется в режиме constant_memory: каждая строка записывается один раз
+    и сразу сбрасывается на диск, поэтому память не растет с размером таблицы.
+    Выравнивание ячеек календаря задается форматом столбцов, а цвет и рамка -
+    условным форматированием диапазона, а не форматом каждой ячейки.
+    """
     output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
     
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        # Лист 1: Календарная таблица
-        df = create_calendar_table(scheduler, daily_shifts)
-        if df is not None:
-            df.to_excel(writer, sheet_name='Распределение', index=False)
-            
-            # Форматирование
-            workbook = writer.book
-            worksheet = writer.sheets['Распределение']
-            
-            # Форматы
-            header_format = workbook.add_format({
-                'bold': True,
-                'bg_color': '#4472C4',
-                'font_color': 'white',
-                'border': 1,
-                'align': 'center'
-            })
-            
-            vacation_format = workbook.add_format({
-                'bg_color': '#FFC7CE',
-                'border': 1,
-                'align': 'center'
-            })
-            
-            shift_format = workbook.add_format({
-                'bg_color': '#C6EFCE',
-                'border': 1,
-                'align': 'center'
-            })
-            
-            rest_format = workbook.add_format({
-                'bg_color': '#FFEB9C',
-                'border': 1,
-                'align': 'center'
-            })
-            
-            # Применяем форматирование к заголовкам
-            for col_num, value in enumerate(df.columns.values):
-                worksheet.write(0, col_num, value, header_format)
-                worksheet.set_column(col_num, col_num, 12)
-            
-            # Условное форматирование для ячеек
-            for row_num in range(1, len(df) + 1):
-                for col_num in range(1, len(df.columns) - 2):
-                    cell_value = df.iloc[row_num - 1, col_num]
-                    if cell_value == 'Х':
-                        worksheet.write(row_num, col_num, cell_value, vacation_format)
-                    elif cell_value == '*':
-                        worksheet.write(row_num, col_num, cell_value, rest_format)
-                    elif cell_value and cell_value != '':
-                        worksheet.write(row_num, col_num, cell_value, shift_format)
-        
-        # Лист 2: Статистика
-        stats_data = []
-        for employee in scheduler.employees:
-            stats_data.append({
-                'Сотрудник': employee.name,
-                'Приоритет': employee.priority,
-                'Нарядов': scheduler.employee_stats[employee.id]['shifts_count'],
-                'Осталось слотов': scheduler.employee_stats[employee.id]['monthly_slots'],
-                'Занято дней': len(scheduler.employee_stats[employee.id]['occupied_days'])
-            })
+    # Форматы
+    header_format = workbook.add_format({
+        'bold': True,
+        'bg_color': '#4472C4',
+        'font_color': 'white',
+        'border': 1,
+        'align': 'center'
+    })
+    
+    day_format = workbook.add_format({'align': 'center'})
+    
+    # Условные форматы: заливка и рамка заполненных ячеек (выравнивание - в формате столбца)
+    vacation_format = workbook.add_format({'bg_color': '#FFC7CE', 'border': 1})
+    shift_format = workbook.add_format({'bg_color': '#C6EFCE', 'border': 1})
+    rest_format = workbook.add_format({'bg_color': '#FFEB9C', 'border': 1})
+    
+    # Лист 1: Календарная таблица
+    if df is not None:
+        worksheet = workbook.add_worksheet('Распределение')
+        num_rows, num_cols = df.shape
+        # Дни - все столбцы, кроме ФИО и двух итоговых
+        first_day_col, last_day_col = 1, num_cols - 3
         
-        stats_df = pd.DataFrame(stats_data)
-        stats_df.to_excel(writer, sheet_name='Статистика', index=False)
+        worksheet.set_column(0, num_cols - 1, 12)
+        if last_day_col >= first_day_col:
+            worksheet.set_column(first_day_col, last_day_col, 12, day_format)
+        worksheet.write_row(0, 0, df.columns.tolist(), header_format)
         
-        # Форматирование статистики
-        stats_worksheet = writer.sheets['Статистика']
-        for col_num, value in enumerate(stats_df.columns.values):
-            stats_worksheet.write(0, col_num, value, header_format)
-            stats_worksheet.set_column(col_num, col_num, 18)
+        for row_num, values in enumerate(_excel_rows(df), start=1):
+            worksheet.write_row(row_num, 0, values)
         
-        # Лист 3: Нераспределенные наряды
-        if scheduler.unassigned_shifts:
-            unassigned_data = []
-            for shift in scheduler.unassigned_shifts:
-                reason = scheduler.analyze_unassigned_reason(shift)
-                unassigned_data.append({
-                    'Дата': shift.date.strftime('%d.%m.%Y'),
-                    'Тип наряда': shift.type,
-                    'Дни': '2 дня (с отдыхом)' if shift.type in [1,2,3,4,5,6] else '8 часов',
-                    'Причина': reason
-                })
-            
-            unassigned_df = pd.DataFrame(unassigned_data)
-            unassigned_df.to_excel(writer, sheet_name='Нераспределенные', index=False)
-            
-            # Форматирование нераспределенных
-            unassigned_worksheet = writer.sheets['Нераспределенные']
-            for col_num, value in enumerate(unassigned_df.columns.values):
-                unassigned_worksheet.write(0, col_num, value, header_format)
-                unassigned_worksheet.set_column(col_num, col_num, 25)
+        if num_rows and last_day_col >= first_day_col:
+            cell_range = (1, first_day_col, num_rows, last_day_col)
+            worksheet.conditional_format(*cell_range, {
+                'type': 'cell', 'criteria': '==', 'value': '"Х"',
+                'format': vacation_format, 'stop_if_true': True
+            })
+            worksheet.conditional_format(*cell_range, {
+                'type': 'cell', 'criteria': '==', 'value': '"*"',
+                'format': rest_format, 'stop_if_true': True
+            })
+            worksheet.conditional_format(*cell_range, {
+                'type': 'no_blanks', 'format': shift_format
+            })
+    
+    # Лист 2: Статистика
+    _write_excel_table(workbook.add_worksheet('Статистика'), stats_df, header_format, 18)
     
-    output.seek(0)
+    # Лист 3: Нераспределенные наряды
+    if not unassigned_df.empty:
+        _write_excel_table(workbook.add_worksheet('Нераспределенные'), unassigned_df, header_format, 25)
+    
+    workbook.close()
     return output.getvalue()
 
+def _excel_rows(df, chunk_size=512):
+    """Строки таблицы как значения Python (пропуски - пустые ячейки)
+    
+    Преобразование идет частями, чтобы не создавать копию всей таблицы.
+    """
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        yield from chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None)
+
+def _write_excel_table(worksheet, df, header_format, width):
+    """Простой лист: заголовок и строки, каждая строка пишется один раз"""
+    worksheet.set_column(0, max(len(df.columns) - 1, 0), width)
+    worksheet.write_row(0, 0, df.columns.tolist(), header_format)
+    for row_num, values in enumerate(_excel_rows(df), start=1):
+        worksheet.write_row(row_num, 0, values)
+
+# Кэш производных представлений: ключ - отпечаток состояния расписания, поэтому
+# представления строятся только из планировщика (даты и наряды - shifts_by_date,
+# а не st.session_state.daily_shifts, который меняется при загрузке нового файла).
+# Аргумент с подчеркиванием streamlit не хэширует
+@st.cache_data(max_entries=16, show_spinner=False)
+def cached_calendar_table(fingerprint, _scheduler):
+    return create_calendar_table(_scheduler, _scheduler.shifts_by_date)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cached_unassigned_table(fingerprint, _scheduler):
+    return create_unassigned_table(_scheduler)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cached_charts(fingerprint, _scheduler):
+    """Все графики вкладки статистики: нагрузка, по дням, слоты, временная шкала"""
+    return (
+        create_workload_bar_chart(_scheduler),
+        create_daily_distribution_chart(_scheduler, _scheduler.shifts_by_date),
+        create_slots_pie_chart(_scheduler),
+        create_employee_timeline(_scheduler, _scheduler.shifts_by_date)
+    )
+
+# Файлы экспорта (в архиве - без отметки времени)
+EXPORT_CALENDAR_CSV = "распределение_нарядов.csv"
+EXPORT_REPORT_XLSX = "отчет_распределения.xlsx"
+EXPORT_UNASSIGNED_CSV = "нераспределенные_наряды.csv"
+EXPORT_SHIFTS_PARQUET = "наряды.parquet"
+EXPORT_SHIFTS_JSONL = "наряды.jsonl"
+EXPORT_BUNDLE_ZIP = "экспорт_нарядов.zip"
+
+@st.cache_resource
+def get_export_manager():
+    """Общий для всех сессий пул фоновой подготовки экспорта"""
+    return ExportManager(max_workers=2, max_jobs=8)
+
+def create_export_steps(df, stats_df, unassigned_df, records):
+    """Шаги фоновой подготовки файлов из снятых в основном потоке таблиц
+    
+    Все файлы и архив используют одну и ту же календарную таблицу;
+    Parquet и JSON Lines строятся из длинного снимка нарядов (records).
+    """
+    steps = [
+        (EXPORT_CALENDAR_CSV, lambda files: df.to_csv(index=False).encode('utf-8-sig')),
+        (EXPORT_REPORT_XLSX, lambda files: build_excel_report(df, stats_df, unassigned_df[UNASSIGNED_EXCEL_COLUMNS]))
+    ]
+    if not unassigned_df.empty:
+        steps.append((
+            EXPORT_UNASSIGNED_CSV,
+            lambda files: unassigned_df[UNASSIGNED_CSV_COLUMNS].to_csv(index=False).encode('utf-8-sig')
+        ))
+    if schedule_export.pa is not None:
+        steps.append((EXPORT_SHIFTS_PARQUET, lambda files: schedule_export.records_to_bytes(records, 'parquet')))
+    steps.append((EXPORT_SHIFTS_JSONL, lambda files: schedule_export.records_to_bytes(records, 'jsonl')))
+    bundled = [name for name, _ in steps]
+    steps.append((EXPORT_BUNDLE_ZIP, lambda files: build_zip(files, bundled)))
+    return steps
+
+def timestamped_file_name(name):
+    """Имя файла для скачивания с отметкой времени"""
+    stem, ext = os.path.splitext(name)
+    return f"{stem}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
+
 # Проверка лицензии
 if not st.session_state.authenticated:
     st.title("🔐 Активация доступа")
@@ -564,13 +682,18 @@ with st.sidebar:
     # Секция 1: Загрузка расписания
     st.subheader("1. Загрузка расписания")
     uploaded_file = st.file_uploader(
-        "Выберите CSV файл с расписанием",
-        type=['csv'],
-        help="Формат: дата;наряды (например: 01.10.2025;1,2,3,4)"
+        "Выберите CSV или XLSX файл с расписанием",
+        type=['csv', 'xlsx'],
+        help="Формат: дата;наряды (например: 01.10.2025;1,2,3,4). Строки с одной датой складываются"
     )
     
     if uploaded_file:
-        st.session_state.daily_shifts = read_schedule_from_csv(uploaded_file)
+        # Файл разбирается один раз, а не при каждом перезапуске скрипта
+        upload_key = (uploaded_file.name, uploaded_file.size, getattr(uploaded_file, 'file_id', None))
+        if st.session_state.demand_upload_key != upload_key:
+            st.session_state.daily_shifts, st.session_state.demand_report = read_schedule_from_csv(uploaded_file)
+            st.session_state.demand_upload_key = upload_key
+        show_demand_report(st.session_state.demand_report)
         if st.session_state.daily_shifts:
             total_shifts = sum(len(shifts) for shifts in st.session_state.daily_shifts.values())
             st.success(f"✅ Загружено {len(st.session_state.daily_shifts)} дней, {total_shifts} нарядов")
@@ -663,8 +786,57 @@ with st.sidebar:
     
     st.session_state.employees_data = employees_data
     
+    # Предварительная проверка выполнимости (до расхода генерации)
+    if st.session_state.daily_shifts and any(emp['name'].strip() for emp in employees_data):
+        # Без предупреждений о датах: они выводятся при генерации и обновлении расписания
+        feasibility = build_scheduler(employees_data, warn=False).check_feasibility(st.session_state.daily_shifts)
+        
+        with st.expander("🔎 Проверка выполнимости", expanded=bool(feasibility['short_days'])):
+            if feasibility['min_unassigned'] == 0:
+                st.success("Явных дефицитов сотрудников не найдено")
+            else:
+                st.warning(f"Не менее {feasibility['min_unassigned']} нарядов останутся нераспределенными")
+            
+            st.caption(f"Слоты суточных нарядов: нужно {feasibility['slot_demand']}, доступно {feasibility['slot_capacity']}")
+            
+            if feasibility['short_days']:
+                short_df = pd.DataFrame([
+                    {
+                        'Дата': day['date'].strftime('%d.%m.%Y'),
+                        'Сотрудников': day['supply'],
+                        'Занято мест': day['demand'],
+                        'Дефицит': day['shortage']
+                    }
+                    for day in feasibility['days'] if day['shortage'] > 0
+                ])
+                st.dataframe(short_df, use_container_width=True, hide_index=True)
+    
     st.markdown("---")
     
+    # Метод распределения
+    solver_mode = st.radio(
+        "Метод распределения",
+        options=["greedy", "optimal"],
+        format_func=lambda x: "Быстрый (жадный)" if x == "greedy" else "Оптимальный (минимум нераспределенных)",
+        key="solver_mode",
+        help="Оптимальный метод решает задачу назначения точно, но может занять больше времени"
+    )
+    if solver_mode == "optimal":
+        solver_time_limit = st.slider("Лимит времени, сек", min_value=1, max_value=60, value=10, key="solver_time_limit")
+    else:
+        constrained_first = st.checkbox(
+            "Сначала дефицитные наряды",
+            value=False,
+            key="constrained_first",
+            help="Первыми распределяются наряды, на которые меньше всего подходящих сотрудников"
+        )
+    improve_after = st.checkbox(
+        "Доработать локальным поиском",
+        value=True,
+        key="improve_after",
+        help="Доразмещает нераспределенные наряды, убирает нежелательные даты и выравнивает нагрузку"
+    )
+    
     # Кнопка генерации расписания
     if st.button("🚀 Сгенерировать расписание", type="primary", use_container_width=True):
         if not st.session_state.daily_shifts:
@@ -691,33 +863,69 @@ with st.sidebar:
                         st.session_state.license_data = updated_data
             
             if can_generate:
-                # Создаем новый scheduler
-                scheduler = ShiftScheduler()
+                # Создаем новый scheduler с сотрудниками
+                scheduler = build_scheduler(employees_data)
                 
-                # Добавляем сотрудников
-                for emp_data in employees_data:
-                    if emp_data['name'].strip():
-                        vacation_days = parse_date_list(emp_data['vacation'])
-                        exclusion_days = parse_date_list(emp_data['exclusion'])
-                        priority = emp_data.get('priority', 0)
-                        scheduler.add_employee(
-                            emp_data['name'].strip(),
-                            vacation_days,
-                            exclusion_days,
-                            priority
-                        )
+                # Одинаковые входные данные и параметры дают готовый результат из кэша
+                if solver_mode == "optimal":
+                    options = {'solver': solver_mode, 'time_limit': solver_time_limit}
+                else:
+                    options = {'solver': solver_mode, 'constrained_first': constrained_first}
+                options['improve'] = improve_after
+                schedule_cache = get_schedule_cache()
+                cache_key = scheduler.input_fingerprint(st.session_state.daily_shifts, **options)
+                cached = schedule_cache.get(cache_key)
                 
-                # Генерируем расписание
-                scheduler.generate_schedule(st.session_state.daily_shifts)
+                if cached is not None:
+                    scheduler, st.session_state.solver_report, st.session_state.improve_report = cached
+                else:
+                    # Генерируем расписание (numpy уже установлен вместе с pandas)
+                    if solver_mode == "optimal":
+                        st.session_state.solver_report = scheduler.generate_optimal_schedule(
+                            st.session_state.daily_shifts,
+                            time_limit=solver_time_limit
+                        )
+                    else:
+                        scheduler.generate_schedule(
+                            st.session_state.daily_shifts,
+                            engine="numpy",
+                            ordering="constrained" if constrained_first else "date"
+                        )
+                        st.session_state.solver_report = None
+                    
+                    st.session_state.improve_report = scheduler.improve_schedule(time_limit=1.0) if improve_after else None
+                    schedule_cache.put(cache_key, (scheduler, st.session_state.solver_report, st.session_state.improve_report))
                 
                 st.session_state.scheduler = scheduler
                 st.session_state.schedule_generated = True
                 st.success("✅ Расписание сгенерировано!")
                 st.rerun()
+    
+    # Изменения отпусков после генерации применяются без полной перегенерации
+    if st.session_state.schedule_generated and st.session_state.scheduler:
+        changed_employees = find_changed_constraints(st.session_state.scheduler, employees_data)
+        if changed_employees:
+            st.info(f"📝 Изменены даты у сотрудников: {', '.join(emp.name for emp, _, _ in changed_employees)}")
+            if st.button("♻️ Обновить расписание", use_container_width=True,
+                         help="Переназначаются только наряды, затронутые изменениями"):
+                released = reassigned = 0
+                for employee, vacation_days, exclusion_days in changed_employees:
+                    update_report = st.session_state.scheduler.update_employee_constraints(
+                        employee.id,
+                        vacation_days=vacation_days,
+                        preferred_exclusion_days=exclusion_days
+                    )
+                    released += update_report['released']
+                    reassigned += update_report['reassigned']
+                st.success(f"✅ Снято нарядов: {released}, переназначено: {reassigned}")
+                st.rerun()
 
 # Основная область - отображение результатов
+# Фоновый экспорт, за которым нужно следить (опрос - в конце скрипта)
+export_polling = None
 if st.session_state.schedule_generated and st.session_state.scheduler:
     scheduler = st.session_state.scheduler
+    fingerprint = scheduler.schedule_fingerprint
     
     # Вкладки для разных представлений
     tab1, tab2, tab3, tab4 = st.tabs(["📊 Статистика", "📅 Календарь", "✏️ Редактор", "⚠️ Нераспределенные"])
@@ -728,7 +936,7 @@ if st.session_state.schedule_generated and st.session_state.scheduler:
         # Общая статистика
         col1, col2, col3, col4 = st.columns(4)
         
-        total_requested = sum(len(shifts) for shifts in st.session_state.daily_shifts.values())
+        total_requested = sum(len(shifts) for shifts in scheduler.shifts_by_date.values())
         
         with col1:
             st.metric("Всего нарядов", total_requested)
@@ -739,22 +947,32 @@ if st.session_state.schedule_generated and st.session_state.scheduler:
         with col4:
             st.metric("Сотрудников", len(scheduler.employees))
         
+        # Отчет оптимального метода
+        report = st.session_state.solver_report
+        if report:
+            st.info(
+                f"**Метод:** {'оптимальный' if report['solver'] == 'milp' else 'жадный'} | {report['status']}\n\n"
+                f"Нераспределено жадным методом: {report['greedy_unassigned']}, "
+                f"итог: {report['unassigned']} (выигрыш {report['gap']})"
+                + (f", нижняя оценка: {report['lower_bound']}" if report['lower_bound'] is not None else "")
+                + f" | {report['elapsed']:.1f} сек"
+            )
+        
+        improve_report = st.session_state.improve_report
+        if improve_report:
+            st.info(
+                f"**Локальный поиск:** размещено {improve_report['placed']}, "
+                f"убрано нежелательных дат {improve_report['exclusions_fixed']}, "
+                f"перенесено для выравнивания {improve_report['balanced']} "
+                f"({improve_report['iterations']} проверок за {improve_report['elapsed']:.2f} сек)"
+            )
+        
         st.markdown("---")
         
         # Статистика по сотрудникам
         st.subheader("Нагрузка по сотрудникам")
         
-        stats_data = []
-        for employee in scheduler.employees:
-            stats_data.append({
-                'Сотрудник': employee.name,
-                'Приоритет': employee.priority,
-                'Нарядов': scheduler.employee_stats[employee.id]['shifts_count'],
-                'Осталось слотов': scheduler.employee_stats[employee.id]['monthly_slots'],
-                'Занято дней': len(scheduler.employee_stats[employee.id]['occupied_days'])
-            })
-        
-        stats_df = pd.DataFrame(stats_data)
+        stats_df = create_stats_table(scheduler)
         st.dataframe(stats_df, use_container_width=True)
         
         st.markdown("---")
@@ -763,24 +981,21 @@ if st.session_state.schedule_generated and st.session_state.scheduler:
         st.subheader("📈 Визуализация нагрузки")
         
         col1, col2 = st.columns(2)
+        fig_bar, fig_daily, fig_pie, timeline_fig = cached_charts(fingerprint, scheduler)
         
         with col1:
             # Столбчатая диаграмма распределения нарядов
-            fig_bar = create_workload_bar_chart(scheduler)
             st.plotly_chart(fig_bar, use_container_width=True)
             
             # График распределения по дням
-            fig_daily = create_daily_distribution_chart(scheduler, st.session_state.daily_shifts)
             st.plotly_chart(fig_daily, use_container_width=True)
         
         with col2:
             # Круговая диаграмма использования слотов
-            fig_pie = create_slots_pie_chart(scheduler)
             st.plotly_chart(fig_pie, use_container_width=True)
         
         # Временная шкала нарядов
         st.subheader("⏱️ Временная шкала нарядов")
-        timeline_fig = create_employee_timeline(scheduler, st.session_state.daily_shifts)
         if timeline_fig:
             st.plotly_chart(timeline_fig, use_container_width=True)
         else:
@@ -789,7 +1004,7 @@ if st.session_state.schedule_generated and st.session_state.scheduler:
     with tab2:
         st.header("Календарное распределение")
         
-        df = create_calendar_table(scheduler, st.session_state.daily_shifts)
+        df = cached_calendar_table(fingerprint, scheduler)
         if df is not None:
             st.dataframe(df, use_container_width=True)
             
@@ -804,64 +1019,114 @@ if st.session_state.schedule_generated and st.session_state.scheduler:
             if not can_download:
                 st.warning("⚠️ Экспорт файлов недоступен в демо-режиме. Активируйте полную лицензию для доступа к экспорту.")
             else:
-                col1, col2, col3 = st.columns(3)
+                # Файлы готовятся в фоне по запросу и хранятся для текущего состояния расписания
+                export_manager = get_export_manager()
+                export_job = export_manager.get(fingerprint)
                 
-                with col1:
-                    # Экспорт таблицы распределения
-                    csv_buffer = io.StringIO()
-                    df.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
-                    st.download_button(
-                        label="📄 CSV: Распределение",
-                        data=csv_buffer.getvalue(),
-                        file_name=f"распределение_нарядов_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                        mime="text/csv",
-                        use_container_width=True
-                    )
+                if export_job is None or (export_job.is_done and not export_job.succeeded):
+                    if export_job is not None:
+                        st.error(f"❌ Ошибка подготовки экспорта: {export_job.error}")
+                    if st.button("📦 Подготовить файлы экспорта", use_container_width=True):
+                        # Снимок таблиц делается здесь: фоновые шаги не обращаются к планировщику
+                        export_job = export_manager.submit(fingerprint, create_export_steps(
+                            df,
+                            create_stats_table(scheduler),
+                            cached_unassigned_table(fingerprint, scheduler),
+                            schedule_export.collect_shift_records(scheduler)
+                        ))
                 
-                with col2:
-                    # Экспорт в Excel
-                    excel_data = export_to_excel(scheduler, st.session_state.daily_shifts)
-                    st.download_button(
-                        label="📊 Excel: Полный отчет",
-                        data=excel_data,
-                        file_name=f"отчет_распределения_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
-                    )
+                if export_job is not None and not export_job.is_done:
+                    st.progress(export_job.progress, text=export_job.stage)
+                    export_polling = export_job
                 
-                with col3:
-                    # Экспорт нераспределенных нарядов
-                    if scheduler.unassigned_shifts:
-                        unassigned_data = []
-                        for shift in scheduler.unassigned_shifts:
-                            reason = scheduler.analyze_unassigned_reason(shift)
-                            unassigned_data.append({
-                                'Дата': shift.date.strftime('%d.%m.%Y'),
-                                'Тип наряда': shift.type,
-                                'Причина': reason
-                            })
-                        
-                        unassigned_df = pd.DataFrame(unassigned_data)
-                        csv_buffer2 = io.StringIO()
-                        unassigned_df.to_csv(csv_buffer2, index=False, encoding='utf-8-sig')
-                        
+                if export_job is not None and export_job.succeeded:
+                    files = export_job.files
+                    col1, col2, col3, col4 = st.columns(4)
+                    
+                    with col1:
+                        # Экспорт таблицы распределения
                         st.download_button(
-                            label="⚠️ CSV: Нераспределенные",
-                            data=csv_buffer2.getvalue(),
-                            file_name=f"нераспределенные_наряды_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                            label="📄 CSV: Распределение",
+                            data=files[EXPORT_CALENDAR_CSV],
+                            file_name=timestamped_file_name(EXPORT_CALENDAR_CSV),
                             mime="text/csv",
                             use_container_width=True
                         )
+                    
+                    with col2:
+                        # Экспорт в Excel
+                        st.download_button(
+                            label="📊 Excel: Полный отчет",
+                            data=files[EXPORT_REPORT_XLSX],
+                            file_name=timestamped_file_name(EXPORT_REPORT_XLSX),
+                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                            use_container_width=True
+                        )
+                    
+                    with col3:
+                        # Экспорт нераспределенных нарядов
+                        if EXPORT_UNASSIGNED_CSV in files:
+                            st.download_button(
+                                label="⚠️ CSV: Нераспределенные",
+                                data=files[EXPORT_UNASSIGNED_CSV],
+                                file_name=timestamped_file_name(EXPORT_UNASSIGNED_CSV),
+                                mime="text/csv",
+                                use_container_width=True
+                            )
+                    
+                    with col4:
+                        # Все файлы одним архивом
+                        st.download_button(
+                            label="📦 ZIP: Все файлы",
+                            data=files[EXPORT_BUNDLE_ZIP],
+                            file_name=timestamped_file_name(EXPORT_BUNDLE_ZIP),
+                            mime="application/zip",
+                            use_container_width=True
+                        )
+                    
+                    # Длинный формат для внешних систем: одна строка на наряд
+                    st.caption("Для учета и аналитики: одна строка на наряд (дата, тип, сотрудник, причина нераспределения)")
+                    col1, col2 = st.columns(2)
+                    
+                    with col1:
+                        if EXPORT_SHIFTS_PARQUET in files:
+                            st.download_button(
+                                label="🗂️ Parquet: Наряды",
+                                data=files[EXPORT_SHIFTS_PARQUET],
+                                file_name=timestamped_file_name(EXPORT_SHIFTS_PARQUET),
+                                mime="application/vnd.apache.parquet",
+                                use_container_width=True
+                            )
+                    
+                    with col2:
+                        st.download_button(
+                            label="🧾 JSON Lines: Наряды",
+                            data=files[EXPORT_SHIFTS_JSONL],
+                            file_name=timestamped_file_name(EXPORT_SHIFTS_JSONL),
+                            mime="application/x-ndjson",
+                            use_container_width=True
+                        )
     
     with tab3:
         st.header("✏️ Ручное редактирование распределения")
         
         st.info("В этом разделе вы можете вручную изменить назначения нарядов")
         
+        # Отмена и повтор правок без перегенерации
+        col_undo, col_redo = st.columns(2)
+        with col_undo:
+            if st.button("↩️ Отменить", use_container_width=True, disabled=not scheduler.can_undo):
+                scheduler.undo()
+                st.rerun()
+        with col_redo:
+            if st.button("↪️ Повторить", use_container_width=True, disabled=not scheduler.can_redo):
+                scheduler.redo()
+                st.rerun()
+        
         # Получаем список всех нарядов для редактирования
         edit_data = []
         for shift in scheduler.assigned_shifts:
-            employee = next((e for e in scheduler.employees if e.id == shift.employee_id), None)
+            employee = scheduler.employee_by_id.get(shift.employee_id)
             edit_data.append({
                 'Дата': shift.date.strftime('%d.%m.%Y'),
                 'Тип наряда': shift.type,
@@ -908,49 +1173,41 @@ if st.session_state.schedule_generated and st.session_state.scheduler:
                 )
             
             if st.button("💾 Сохранить изменение", use_container_width=True):
-                # Применяем изменение
+                # Применяем изменение: проверка ограничений и статистика - в планировщике
                 shift_to_edit = shifts_on_date[selected_shift_idx]['shift_obj']
-                old_employee = next((e for e in scheduler.employees if e.id == shift_to_edit.employee_id), None)
-                new_emp = next((e for e in scheduler.employees if e.name == new_employee), None)
+                new_emp = scheduler.employee_by_name.get(new_employee)
                 
                 if new_emp:
-                    # Проверяем доступность нового сотрудника
-                    available = scheduler._is_employee_available(new_emp, shift_to_edit.date, shift_to_edit.type)
+                    success, message = scheduler.reassign(shift_to_edit, new_emp.id)
                     
-                    if available:
-                        # Обновляем статистику старого сотрудника
-                        if old_employee:
-                            scheduler.employee_stats[old_employee.id]['shifts_count'] -= 1
-                            scheduler.employee_stats[old_employee.id]['monthly_slots'] += 1
-                            
-                            # Удаляем занятые дни
-                            days_to_remove = [shift_to_edit.date]
-                            if shift_to_edit.type in [1, 2, 3, 4, 5, 6]:
-                                days_to_remove.append(shift_to_edit.date + timedelta(days=1))
-                            
-                            for day in days_to_remove:
-                                if day in scheduler.employee_stats[old_employee.id]['occupied_days']:
-                                    scheduler.employee_stats[old_employee.id]['occupied_days'].remove(day)
-                        
-                        # Назначаем новому сотруднику
-                        shift_to_edit.employee_id = new_emp.id
-                        scheduler.employee_stats[new_emp.id]['shifts_count'] += 1
-                        scheduler.employee_stats[new_emp.id]['monthly_slots'] -= 1
-                        
-                        # Добавляем занятые дни
-                        days_to_add = [shift_to_edit.date]
-                        if shift_to_edit.type in [1, 2, 3, 4, 5, 6]:
-                            days_to_add.append(shift_to_edit.date + timedelta(days=1))
-                        
-                        for day in days_to_add:
-                            scheduler.employee_stats[new_emp.id]['occupied_days'].add(day)
-                        
+                    if success:
                         # Обновляем session state
                         st.session_state.scheduler = scheduler
-                        st.success(f"✅ Наряд успешно переназначен на {new_employee}")
+                        st.success(f"✅ {message}")
                         st.rerun()
                     else:
-                        st.error(f"❌ Сотрудник {new_employee} недоступен на эту дату (отпуск, превышен лимит или уже занят)")
+                        st.error(f"❌ {message}")
+            
+            st.markdown("---")
+            st.subheader("Обменять наряды")
+            
+            shift_labels = [f"{d['Дата']} - тип {d['Тип наряда']} - {d['Назначен']}" for d in edit_data]
+            col1, col2 = st.columns(2)
+            with col1:
+                swap_a = st.selectbox("Первый наряд", options=range(len(edit_data)),
+                                      format_func=lambda x: shift_labels[x], key="swap_a")
+            with col2:
+                swap_b = st.selectbox("Второй наряд", options=range(len(edit_data)),
+                                      format_func=lambda x: shift_labels[x], key="swap_b")
+            
+            if st.button("🔄 Обменять исполнителей", use_container_width=True):
+                success, message = scheduler.swap(edit_data[swap_a]['shift_obj'], edit_data[swap_b]['shift_obj'])
+                if success:
+                    st.session_state.scheduler = scheduler
+                    st.success(f"✅ {message}")
+                    st.rerun()
+                else:
+                    st.error(f"❌ {message}")
         else:
             st.info("Нет назначенных нарядов для редактирования")
     
@@ -960,18 +1217,9 @@ if st.session_state.schedule_generated and st.session_state.scheduler:
         if scheduler.unassigned_shifts:
             st.warning(f"⚠️ Не удалось распределить {len(scheduler.unassigned_shifts)} нарядов")
             
-            unassigned_data = []
-            for shift in scheduler.unassigned_shifts:
-                reason = scheduler.analyze_unassigned_reason(shift)
-                unassigned_data.append({
-                    'Дата': shift.date.strftime('%d.%m.%Y'),
-                    'Тип наряда': shift.type,
-                    'Дни': '2 дня (с отдыхом)' if shift.type in [1,2,3,4,5,6] else '8 часов',
-                    'Причина': reason
-                })
-            
-            unassigned_df = pd.DataFrame(unassigned_data)
+            unassigned_df = cached_unassigned_table(fingerprint, scheduler)
             st.dataframe(unassigned_df, use_container_width=True)
+            st.caption("Число сотрудников, которым мешало каждое ограничение в момент распределения")
             
             # Анализ причин
             st.subheader("Анализ причин")
@@ -1012,3 +1260,8 @@ else:
 # Футер
 st.markdown("---")
 st.caption("Система автоматического распределения нарядов v1.0")
+
+# Опрос фонового экспорта: перезапуск в самом конце, чтобы все вкладки успели отрисоваться
+if export_polling is not None:
+    export_polling.done.wait(timeout=0.5)
+    st.rerun()
@@ -0,0 +1,221 @@
+import csv
+import io
+import itertools
+from datetime import date, datetime
+from functools import lru_cache
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import openpyxl
+except ImportError:  # openpyxl нужен только для файлов XLSX
+    openpyxl = None
+
+# Допустимые типы нарядов
+SHIFT_TYPES = range(1, 8)
+
+# Форматы дат во входных файлах (первый - основной)
+DATE_FORMATS = ("%d.%m.%Y", "%Y-%m-%d", "%d/%m/%Y")
+
+# Кодировки CSV: UTF-8 (с BOM или без) и Windows-1251 из русского Excel
+CSV_ENCODINGS = ("utf-8-sig", "cp1251")
+
+# Сколько ошибок хранить в отчете (общее число считается всегда)
+MAX_REPORTED_ERRORS = 200
+
+
+@lru_cache(maxsize=4096)
+def parse_date(text: str) -> datetime:
+    """Разбор даты из строки (результат кэшируется: даты в файле повторяются)"""
+    text = text.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+    raise ValueError(f"неверная дата '{text}', используйте ДД.ММ.ГГГГ")
+
+
+@lru_cache(maxsize=64)
+def parse_shift_list(text: str) -> Tuple[Tuple[int, ...], Tuple[str, ...]]:
+    """Типы нарядов из строки вида "1,2,3": (допустимые типы, неверные значения)"""
+    shift_types, invalid = [], []
+    for token in text.split(','):
+        token = token.strip()
+        if not token:
+            continue
+        try:
+            shift_type = int(token)
+        except ValueError:
+            invalid.append(token)
+            continue
+        if shift_type in SHIFT_TYPES:
+            shift_types.append(shift_type)
+        else:
+            invalid.append(token)
+    return tuple(shift_types), tuple(invalid)
+
+
+class DemandReport:
+    """Итог чтения файла потребности: число строк, дней, нарядов и ошибки по строкам"""
+
+    def __init__(self, file_format: str):
+        self.format = file_format
+        self.delimiter: Optional[str] = None
+        self.encoding: Optional[str] = None
+        self.rows = 0
+        self.shifts = 0
+        self.duplicate_dates = 0
+        self.ignored_cells = 0
+        self.error_count = 0
+        self.errors: List[Tuple[int, str]] = []
+
+    def add_error(self, line: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+
+def read_demand(file: BinaryIO, filename: str = "") -> Tuple[Dict[datetime, List[int]], DemandReport]:
+    """Чтение потребности в нарядах из CSV или XLSX (по расширению имени файла)
+
+    Строка файла: дата, затем типы нарядов - через запятую в одной ячейке
+    и/или в следующих ячейках. В CSV с разделителем ';' (основной формат)
+    типы берутся только из ячейки после даты, остальные ячейки (например,
+    комментарий) пропускаются и считаются в отчете. Первая строка, в первой
+    ячейке которой нет даты и цифр, считается заголовком и пропускается. Несколько строк с одной
+    датой (разные подразделения) складываются. Ошибочные значения не
+    прерывают чтение, а попадают в отчет.
+    """
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        return read_demand_xlsx(file)
+    return read_demand_csv(file)
+
+
+def read_demand_csv(file: BinaryIO) -> Tuple[Dict[datetime, List[int]], DemandReport]:
+    """Потоковое чтение CSV: строки разбираются по мере чтения, файл целиком не загружается"""
+    for encoding in CSV_ENCODINGS:
+        try:
+            return _read_csv_with_encoding(file, encoding)
+        except UnicodeDecodeError:
+            # Следующую кодировку можно попробовать, только если файл перематывается
+            if not file.seekable():
+                raise
+            file.seek(0)
+    raise ValueError("Не удалось определить кодировку файла")
+
+
+def _read_csv_with_encoding(file: BinaryIO, encoding: str) -> Tuple[Dict[datetime, List[int]], DemandReport]:
+    report = DemandReport('csv')
+    report.encoding = encoding
+    text = io.TextIOWrapper(file, encoding=encoding, newline='')
+    try:
+        first_line = text.readline()
+        report.delimiter = detect_delimiter(first_line)
+        rows = csv.reader(itertools.chain([first_line], text), delimiter=report.delimiter)
+        # В основном формате список типов занимает одну ячейку
+        shift_columns = 1 if report.delimiter == ';' else None
+        daily_shifts = _collect_rows(((rows.line_num, row) for row in rows), report, shift_columns)
+    finally:
+        # Поток загруженного файла закрывает вызывающий код
+        text.detach()
+    return daily_shifts, report
+
+
+def read_demand_xlsx(file: BinaryIO) -> Tuple[Dict[datetime, List[int]], DemandReport]:
+    """Чтение первого листа XLSX в режиме read_only (строки читаются по одной)"""
+    if openpyxl is None:
+        raise ImportError("Для чтения XLSX требуется пакет openpyxl")
+
+    report = DemandReport('xlsx')
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        daily_shifts = _collect_rows(enumerate(rows, start=1), report)
+    finally:
+        workbook.close()
+    return daily_shifts, report
+
+
+def detect_delimiter(line: str) -> str:
+    """Разделитель по первой строке: ';' (основной формат), табуляция или ','"""
+    for delimiter in (';', '\t'):
+        if delimiter in line:
+            return delimiter
+    return ','
+
+
+def _collect_rows(rows: Iterable[Tuple[int, tuple]], report: DemandReport,
+                  shift_columns: Optional[int] = None) -> Dict[datetime, List[int]]:
+    """Сборка потребности по датам из пронумерованных строк
+
+    shift_columns - сколько столбцов после даты содержат типы нарядов (None - все).
+    """
+    daily_shifts: Dict[datetime, List[int]] = {}
+    first = True
+
+    for line, row in rows:
+        cells = [(column, cell) for column, cell in enumerate(row)
+                 if cell is not None and str(cell).strip() != '']
+        if not cells:
+            continue
+
+        date_column, date_cell = cells[0]
+        try:
+            day = _cell_date(date_cell)
+        except ValueError as e:
+            # Первая непустая строка без даты - заголовок, если в первой ячейке нет цифр;
+            # иначе это ошибка в дате, а не заголовок
+            if not (first and _is_header(date_cell)):
+                report.add_error(line, str(e))
+            first = False
+            continue
+        first = False
+        report.rows += 1
+
+        shift_cells = []
+        for column, cell in cells[1:]:
+            if shift_columns is None or column - date_column <= shift_columns:
+                shift_cells.append(cell)
+            else:
+                report.ignored_cells += 1
+
+        shift_types = []
+        for cell in shift_cells:
+            valid, invalid = _cell_shifts(cell)
+            shift_types.extend(valid)
+            for token in invalid:
+                report.add_error(line, f"неверный тип наряда '{token}' (допустимы 1-7)")
+
+        if day in daily_shifts:
+            report.duplicate_dates += 1
+            daily_shifts[day].extend(shift_types)
+        else:
+            daily_shifts[day] = shift_types
+        report.shifts += len(shift_types)
+
+    return daily_shifts
+
+
+def _is_header(cell) -> bool:
+    """Первая ячейка похожа на заголовок: текст без цифр (в дате они были бы)"""
+    return not any(char.isdigit() for char in str(cell))
+
+
+def _cell_date(cell) -> datetime:
+    """Дата из ячейки: datetime/date из XLSX или строка"""
+    if isinstance(cell, datetime):
+        return datetime(cell.year, cell.month, cell.day)
+    if isinstance(cell, date):
+        return datetime(cell.year, cell.month, cell.day)
+    return parse_date(str(cell))
+
+
+def _cell_shifts(cell) -> Tuple[Tuple[int, ...], Tuple[str, ...]]:
+    """Типы нарядов из ячейки: число из XLSX или строка со списком"""
+    if isinstance(cell, bool):
+        return (), (str(cell),)
+    if isinstance(cell, (int, float)):
+        if float(cell).is_integer() and int(cell) in SHIFT_TYPES:
+            return (int(cell),), ()
+        return (), (str(cell),)
+    return parse_shift_list(str(cell))
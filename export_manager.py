@@ -0,0 +1,112 @@
+import io
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Шаг экспорта: имя файла и функция, получающая уже готовые файлы задания
+ExportStep = Tuple[str, Callable[[Dict[str, bytes]], bytes]]
+
+
+class ExportJob:
+    """Состояние подготовки файлов экспорта для одного отпечатка расписания"""
+
+    def __init__(self, fingerprint: str, total_steps: int):
+        self.fingerprint = fingerprint
+        self.total_steps = total_steps
+        self.completed_steps = 0
+        self.stage = "В очереди"
+        self.files: Dict[str, bytes] = {}
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+    @property
+    def progress(self) -> float:
+        """Доля выполненных шагов (0..1)"""
+        if not self.total_steps:
+            return 1.0
+        return self.completed_steps / self.total_steps
+
+    @property
+    def is_done(self) -> bool:
+        return self.done.is_set()
+
+    @property
+    def succeeded(self) -> bool:
+        return self.is_done and self.error is None
+
+
+class ExportManager:
+    """Подготовка файлов экспорта в пуле потоков
+
+    Задание создается по запросу и выполняется в фоне, не блокируя отрисовку.
+    Результаты хранятся по отпечатку расписания: повторный запрос для того же
+    состояния возвращает готовое (или выполняющееся) задание. Хранится не
+    более max_jobs заданий, первыми вытесняются самые давние завершенные.
+
+    Шаги получают только заранее снятые копии данных (таблицы), а не
+    планировщик, который в это время может изменяться в основном потоке.
+    """
+
+    def __init__(self, max_workers: int = 2, max_jobs: int = 8):
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+        self._jobs: "OrderedDict[str, ExportJob]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint: str) -> Optional[ExportJob]:
+        """Задание для отпечатка, если оно уже создано"""
+        with self._lock:
+            job = self._jobs.get(fingerprint)
+            if job is not None:
+                self._jobs.move_to_end(fingerprint)
+            return job
+
+    def submit(self, fingerprint: str, steps: List[ExportStep]) -> ExportJob:
+        """Запустить подготовку файлов (или вернуть существующее задание)
+
+        Неудачное задание запускается заново.
+        """
+        with self._lock:
+            job = self._jobs.get(fingerprint)
+            if job is not None and (not job.is_done or job.succeeded):
+                self._jobs.move_to_end(fingerprint)
+                return job
+
+            job = ExportJob(fingerprint, len(steps))
+            self._jobs[fingerprint] = job
+            self._jobs.move_to_end(fingerprint)
+            self._evict()
+
+        self._executor.submit(self._run, job, steps)
+        return job
+
+    def _evict(self):
+        """Удалить самые давние завершенные задания сверх лимита (вызывается под блокировкой)"""
+        finished = [key for key, job in self._jobs.items() if job.is_done]
+        excess = len(self._jobs) - self.max_jobs
+        for key in finished[:max(excess, 0)]:
+            del self._jobs[key]
+
+    def _run(self, job: ExportJob, steps: List[ExportStep]):
+        try:
+            for name, build in steps:
+                job.stage = f"Подготовка: {name}"
+                job.files[name] = build(job.files)
+                job.completed_steps += 1
+            job.stage = "Готово"
+        except Exception as e:
+            job.error = str(e)
+            job.stage = "Ошибка"
+        finally:
+            job.done.set()
+
+
+def build_zip(files: Dict[str, bytes], names: Optional[List[str]] = None) -> bytes:
+    """ZIP-архив из готовых файлов (по умолчанию из всех)"""
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name in names if names is not None else list(files):
+            archive.writestr(name, files[name])
+    return output.getvalue()
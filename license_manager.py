@@ -1,20 +1,119 @@
 import sqlite3
 import hashlib
+import hmac
 import uuid
 from datetime import datetime, timedelta
 import os
 import secrets
+import threading
+import time
+import queue
+import re
+from contextlib import contextmanager
+
+from usage_log import UsageLogWriter, create_usage_schema
+
+# Переменная окружения с секретом для отпечатков ключей; если не задана,
+# секрет создается один раз и хранится в базе (таблица license_meta)
+FINGERPRINT_SECRET_ENV = "LICENSE_FINGERPRINT_SECRET"
+
+# Формат ключей, которые выдает generate_license_key
+LICENSE_KEY_PATTERN = re.compile(r"[0-9A-F]{6}(-[0-9A-F]{6}){3}")
+
+# Настройки соединений SQLite: ожидание блокировки (мс), кэш подготовленных
+# запросов на соединение и число соединений, которые держит пул
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 128
+POOL_SIZE = 8
+
+# Базы, схема которых уже создана в этом процессе: путь -> секрет отпечатков
+_initialized_databases = {}
+_init_lock = threading.Lock()
 
 class LicenseManager:
-    def __init__(self, db_path="licenses.db"):
+    def __init__(self, db_path="licenses.db", cache_ttl=30, pool_size=POOL_SIZE,
+                 usage_flush_interval=2.0, usage_retention_days=90):
         self.db_path = db_path
+        # Пул постоянных соединений: соединение берется на время одного вызова
+        # и возвращается, поэтому один менеджер можно разделять между потоками
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        # Кэш успешных проверок: ключ ('license', отпечаток) или ('demo', session_id).
+        # Запись живет не дольше cache_ttl секунд и не дольше срока лицензии/демо;
+        # правки в этом процессе (use_generation, revoke_license) сбрасывают ее сразу
+        self.cache_ttl = cache_ttl
+        self._validation_cache = {}
+        self._cache_lock = threading.Lock()
         self.init_database()
+        # Журнал использования пишется в фоне пачками, с дневными итогами и очисткой старых записей
+        self.usage_log = UsageLogWriter(self._connect, flush_interval=usage_flush_interval,
+                                        retention_days=usage_retention_days)
+    
+    def _connect(self):
+        """Новое соединение: журнал WAL (читатели не ждут писателя), synchronous=NORMAL,
+        ожидание блокировки вместо ошибки "database is locked" и кэш запросов"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,  # транзакции открываются явно в _transaction
+            check_same_thread=False,  # соединение из пула используется одним потоком за раз
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        return conn
+    
+    @contextmanager
+    def _connection(self):
+        """Соединение из пула на время блока (одиночные запросы выполняются в режиме autocommit)"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+    
+    @contextmanager
+    def _transaction(self, immediate=False):
+        """Транзакция на соединении из пула; immediate - сразу взять блокировку записи"""
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn.cursor()
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+    
+    def close(self):
+        """Сохранить журнал использования и закрыть соединения пула"""
+        self.usage_log.close()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
     
     def init_database(self):
-        """Инициализация базы данных лицензий"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        """Инициализация базы данных лицензий (один раз на процесс для каждого файла базы)"""
+        db_key = os.path.abspath(self.db_path)
+        with _init_lock:
+            if db_key in _initialized_databases:
+                self._fingerprint_secret = _initialized_databases[db_key]
+                return
+            with self._transaction(immediate=True) as cursor:
+                self._create_schema(cursor)
+                self._fingerprint_secret = self._load_fingerprint_secret(cursor)
+            _initialized_databases[db_key] = self._fingerprint_secret
+    
+    def _create_schema(self, cursor):
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS licenses (
                 id TEXT PRIMARY KEY,
@@ -26,7 +125,24 @@ class LicenseManager:
                 monthly_generations INTEGER DEFAULT 10,
                 used_generations INTEGER DEFAULT 0,
                 last_reset_date TEXT,
-                is_active BOOLEAN NOT NULL DEFAULT 1
+                is_active BOOLEAN NOT NULL DEFAULT 1,
+                key_fingerprint TEXT
+            )
+        """)
+        
+        # Миграция: отпечаток ключа для поиска лицензии по индексу
+        cursor.execute("PRAGMA table_info(licenses)")
+        if "key_fingerprint" not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE licenses ADD COLUMN key_fingerprint TEXT")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_licenses_fingerprint
+            ON licenses (key_fingerprint)
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS license_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
             )
         """)
         
@@ -39,28 +155,72 @@ class LicenseManager:
             )
         """)
         
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS usage_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                license_key TEXT,
-                session_id TEXT,
-                action TEXT NOT NULL,
-                timestamp TEXT NOT NULL
+        create_usage_schema(cursor)
+    
+    def _load_fingerprint_secret(self, cursor):
+        """Секрет для отпечатков ключей (из окружения или из базы)
+        
+        Если секрет сменился, сохраненные отпечатки сбрасываются и заполняются
+        заново при следующей успешной проверке каждого ключа.
+        """
+        secret = os.environ.get(FINGERPRINT_SECRET_ENV)
+        if not secret:
+            cursor.execute(
+                "INSERT OR IGNORE INTO license_meta (key, value) VALUES ('fingerprint_secret', ?)",
+                (secrets.token_hex(32),)
             )
-        """)
-        
-        conn.commit()
-        conn.close()
+            cursor.execute("SELECT value FROM license_meta WHERE key = 'fingerprint_secret'")
+            secret = cursor.fetchone()[0]
+        
+        secret_id = hashlib.sha256(secret.encode()).hexdigest()[:16]
+        cursor.execute("SELECT value FROM license_meta WHERE key = 'fingerprint_secret_id'")
+        row = cursor.fetchone()
+        if row is None or row[0] != secret_id:
+            cursor.execute("UPDATE licenses SET key_fingerprint = NULL")
+            cursor.execute(
+                "INSERT OR REPLACE INTO license_meta (key, value) VALUES ('fingerprint_secret_id', ?)",
+                (secret_id,)
+            )
+        return secret.encode()
     
     def _hash_key(self, license_key, salt):
         """Хэширование ключа с солью"""
         return hashlib.pbkdf2_hmac('sha256', license_key.encode(), salt.encode(), 100000).hex()
     
+    def _fingerprint_key(self, license_key):
+        """Отпечаток ключа (HMAC-SHA256 с секретом сервера) для поиска по индексу"""
+        return hmac.new(self._fingerprint_secret, license_key.encode(), hashlib.sha256).hexdigest()
+    
+    def _cache_get(self, cache_key):
+        """Запись кэша проверок (valid_until, данные) или None, если ее нет или истек TTL"""
+        with self._cache_lock:
+            entry = self._validation_cache.get(cache_key)
+            if entry is None:
+                return None
+            deadline, valid_until, data = entry
+            if time.monotonic() >= deadline:
+                del self._validation_cache[cache_key]
+                return None
+            return valid_until, data
+    
+    def _cache_put(self, cache_key, valid_until, data):
+        with self._cache_lock:
+            self._validation_cache[cache_key] = (time.monotonic() + self.cache_ttl, valid_until, data)
+    
+    def _cache_invalidate(self, cache_key=None, license_id=None):
+        """Сбросить запись по ключу кэша, все записи лицензии или весь кэш"""
+        with self._cache_lock:
+            if cache_key is None and license_id is None:
+                self._validation_cache.clear()
+                return
+            self._validation_cache.pop(cache_key, None)
+            if license_id is not None:
+                for key in [key for key, (_, _, data) in self._validation_cache.items()
+                            if data.get("license_id") == license_id]:
+                    del self._validation_cache[key]
+    
     def generate_license_key(self, license_type="full", months_valid=12):
         """Генерация нового лицензионного ключа"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         license_id = str(uuid.uuid4())
         license_key = hashlib.sha256(f"{license_id}{datetime.now().isoformat()}".encode()).hexdigest()[:24].upper()
         
@@ -74,63 +234,62 @@ class LicenseManager:
         expiry_date = (datetime.now() + timedelta(days=months_valid*30)).isoformat()
         last_reset_date = datetime.now().isoformat()
         
-        cursor.execute("""
-            INSERT INTO licenses 
-            (id, license_key_hash, salt, license_type, created_date, expiry_date, last_reset_date)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (license_id, key_hash, salt, license_type, created_date, expiry_date, last_reset_date))
-        
-        conn.commit()
-        conn.close()
+        with self._connection() as conn:
+            conn.execute("""
+                INSERT INTO licenses 
+                (id, license_key_hash, salt, license_type, created_date, expiry_date, last_reset_date, key_fingerprint)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (license_id, key_hash, salt, license_type, created_date, expiry_date, last_reset_date,
+                  self._fingerprint_key(formatted_key)))
         
         return formatted_key
     
     def start_demo_session(self):
         """Начать демо-сессию на 3 часа"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         session_id = str(uuid.uuid4())
         start_time = datetime.now()
         expiry_time = start_time + timedelta(hours=3)
         
-        cursor.execute("""
-            INSERT INTO demo_sessions 
-            (session_id, start_time, expiry_time)
-            VALUES (?, ?, ?)
-        """, (session_id, start_time.isoformat(), expiry_time.isoformat()))
-        
-        cursor.execute("""
-            INSERT INTO usage_logs 
-            (session_id, action, timestamp)
-            VALUES (?, ?, ?)
-        """, (session_id, "demo_started", datetime.now().isoformat()))
+        with self._connection() as conn:
+            conn.execute("""
+                INSERT INTO demo_sessions 
+                (session_id, start_time, expiry_time)
+                VALUES (?, ?, ?)
+            """, (session_id, start_time.isoformat(), expiry_time.isoformat()))
         
-        conn.commit()
-        conn.close()
+        self.usage_log.log("demo_started", session_id=session_id)
         
         return session_id, expiry_time
     
     def validate_demo_session(self, session_id):
-        """Проверка валидности демо-сессии"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """Проверка валидности демо-сессии
         
-        cursor.execute("""
-            SELECT * FROM demo_sessions 
-            WHERE session_id = ? AND is_active = 1
-        """, (session_id,))
+        Срок сессии берется из кэша (не дольше cache_ttl), оставшееся время
+        пересчитывается при каждом вызове.
+        """
+        cached = self._cache_get(("demo", session_id))
+        if cached is not None:
+            return self._demo_status(("demo", session_id), cached[0])
         
-        result = cursor.fetchone()
-        conn.close()
+        with self._connection() as conn:
+            result = conn.execute("""
+                SELECT * FROM demo_sessions 
+                WHERE session_id = ? AND is_active = 1
+            """, (session_id,)).fetchone()
         
         if not result:
             return False, "Демо-сессия не найдена"
         
         expiry_time = datetime.fromisoformat(result[2])
+        self._cache_put(("demo", session_id), expiry_time, {})
+        return self._demo_status(("demo", session_id), expiry_time)
+    
+    def _demo_status(self, cache_key, expiry_time):
+        """Результат проверки демо-сессии с оставшимся временем на текущий момент"""
         time_remaining = expiry_time - datetime.now()
         
         if time_remaining.total_seconds() <= 0:
+            self._cache_invalidate(cache_key)
             return False, "Демо-период истек (3 часа)"
         
         hours = int(time_remaining.total_seconds() // 3600)
@@ -142,65 +301,94 @@ class LicenseManager:
             "can_download": False
         }
     
-    def validate_license(self, license_key):
-        """Проверка лицензионного ключа"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _find_license(self, cursor, license_key, fingerprint):
+        """Активная лицензия (строка таблицы) по ключу или None
+        
+        Ключ в неверном формате отклоняется без вычисления PBKDF2. Ключ в верном
+        формате, не найденный по отпечатку, проверяется хэшем по каждой лицензии
+        без отпечатка (созданной до их появления, не проверявшейся с тех пор или
+        после смены секрета): здесь стоимость по-прежнему линейна по числу таких
+        лицензий.
+        """
+        if not LICENSE_KEY_PATTERN.fullmatch(license_key):
+            return None
+        
+        # Ищем лицензию по отпечатку ключа (индекс) и подтверждаем хэшем: одно вычисление PBKDF2
+        cursor.execute("""
+            SELECT * FROM licenses 
+            WHERE key_fingerprint = ? AND is_active = 1
+        """, (fingerprint,))
+        
+        for lic in cursor.fetchall():
+            if hmac.compare_digest(self._hash_key(license_key, lic[2]), lic[1]):  # salt, license_key_hash
+                return lic
         
-        # Получаем все активные лицензии
+        # Лицензии, созданные до появления отпечатков: перебор с хэшем,
+        # найденной лицензии отпечаток записывается для следующих проверок
         cursor.execute("""
             SELECT * FROM licenses 
-            WHERE is_active = 1
+            WHERE key_fingerprint IS NULL AND is_active = 1
         """)
+        for lic in cursor.fetchall():
+            if hmac.compare_digest(self._hash_key(license_key, lic[2]), lic[1]):
+                cursor.execute("""
+                    UPDATE licenses 
+                    SET key_fingerprint = ?
+                    WHERE id = ?
+                """, (fingerprint, lic[0]))
+                return lic
+        
+        return None
+    
+    def validate_license(self, license_key, use_cache=True):
+        """Проверка лицензионного ключа
+        
+        Успешный результат кэшируется на cache_ttl секунд (в пределах срока
+        лицензии и текущего месяца); use_cache=False - всегда читать из базы.
+        """
+        fingerprint = self._fingerprint_key(license_key)
+        cache_key = ("license", fingerprint)
+        current_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
         
-        all_licenses = cursor.fetchall()
-        
-        # Ищем лицензию с подходящим хэшем
-        matching_license = None
-        for lic in all_licenses:
-            stored_hash = lic[1]  # license_key_hash
-            salt = lic[2]  # salt
+        if use_cache:
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                valid_until, data = cached
+                if valid_until is None or datetime.now() <= valid_until:
+                    return True, dict(data)
+                self._cache_invalidate(cache_key)
+        
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            matching_license = self._find_license(cursor, license_key, fingerprint)
             
-            # Вычисляем хэш введенного ключа
-            input_hash = self._hash_key(license_key, salt)
+            if not matching_license:
+                return False, "Неверный лицензионный ключ"
             
-            if input_hash == stored_hash:
-                matching_license = lic
-                break
-        
-        if not matching_license:
-            conn.close()
-            return False, "Неверный лицензионный ключ"
-        
-        # Проверяем срок действия
-        if matching_license[5]:  # expiry_date
-            expiry_date = datetime.fromisoformat(matching_license[5])
-            if datetime.now() > expiry_date:
-                conn.close()
-                return False, "Срок действия лицензии истек"
-        
-        # Проверяем сброс счетчика в новом месяце
-        last_reset = datetime.fromisoformat(matching_license[8])  # last_reset_date
-        current_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        license_id = matching_license[0]
-        
-        if last_reset < current_month:
-            cursor.execute("""
-                UPDATE licenses 
-                SET used_generations = 0, last_reset_date = ?
-                WHERE id = ?
-            """, (datetime.now().isoformat(), license_id))
-            conn.commit()
-            used_generations = 0
-        else:
-            used_generations = matching_license[7]  # used_generations
-        
-        monthly_limit = matching_license[6]  # monthly_generations
-        
-        conn.close()
+            # Проверяем срок действия
+            if matching_license[5]:  # expiry_date
+                expiry_date = datetime.fromisoformat(matching_license[5])
+                if datetime.now() > expiry_date:
+                    return False, "Срок действия лицензии истек"
+            
+            # Проверяем сброс счетчика в новом месяце
+            last_reset = datetime.fromisoformat(matching_license[8])  # last_reset_date
+            
+            license_id = matching_license[0]
+            
+            if last_reset < current_month:
+                cursor.execute("""
+                    UPDATE licenses 
+                    SET used_generations = 0, last_reset_date = ?
+                    WHERE id = ?
+                """, (datetime.now().isoformat(), license_id))
+                used_generations = 0
+            else:
+                used_generations = matching_license[7]  # used_generations
+            
+            monthly_limit = matching_license[6]  # monthly_generations
         
-        return True, {
+        data = {
             "type": "full",
             "license_key": license_key,
             "license_id": license_id,
@@ -209,51 +397,103 @@ class LicenseManager:
             "remaining_generations": monthly_limit - used_generations,
             "can_download": True
         }
+        
+        # Запись действует до конца срока лицензии и не дольше текущего месяца (сброс счетчика)
+        next_month = (current_month + timedelta(days=32)).replace(day=1)
+        expiry_date = datetime.fromisoformat(matching_license[5]) if matching_license[5] else None
+        valid_until = min(next_month, expiry_date) if expiry_date else next_month
+        self._cache_put(cache_key, valid_until, data)
+        
+        return True, dict(data)
     
     def use_generation(self, license_key):
-        """Использовать одну генерацию"""
-        # Сначала валидируем лицензию чтобы получить license_id
-        is_valid, result = self.validate_license(license_key)
+        """Использовать одну генерацию
         
-        if not is_valid:
-            return False, result
+        Ключ проверяется (PBKDF2) до транзакции; сброс счетчика в новом месяце,
+        проверка лимита и списание выполняются в одной транзакции BEGIN IMMEDIATE,
+        поэтому одновременные запросы не превышают лимит. Запись в журнал - в фоне.
+        """
+        with self._connection() as conn:
+            matching_license = self._find_license(conn.cursor(), license_key, self._fingerprint_key(license_key))
         
-        license_id = result["license_id"]
-        monthly_limit = result["monthly_limit"]
-        used = result["used_generations"]
+        if not matching_license:
+            return False, "Неверный лицензионный ключ"
         
-        if used >= monthly_limit:
-            return False, f"Достигнут лимит генераций ({monthly_limit}/месяц)"
+        license_id = matching_license[0]
+        now = datetime.now()
+        current_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._transaction(immediate=True) as cursor:
+            cursor.execute("""
+                UPDATE licenses 
+                SET used_generations = 0, last_reset_date = ?
+                WHERE id = ? AND last_reset_date < ?
+            """, (now.isoformat(), license_id, current_month.isoformat()))
+            
+            # Списание только в пределах лимита и срока действия
+            cursor.execute("""
+                UPDATE licenses 
+                SET used_generations = used_generations + 1
+                WHERE id = ? AND is_active = 1
+                  AND used_generations < monthly_generations
+                  AND (expiry_date IS NULL OR expiry_date >= ?)
+            """, (license_id, now.isoformat()))
+            charged = cursor.rowcount > 0
+            
+            cursor.execute("""
+                SELECT is_active, expiry_date, monthly_generations, used_generations
+                FROM licenses WHERE id = ?
+            """, (license_id,))
+            is_active, expiry_date, monthly_limit, used = cursor.fetchone()
         
-        cursor.execute("""
-            UPDATE licenses 
-            SET used_generations = used_generations + 1
-            WHERE id = ?
-        """, (license_id,))
+        self._cache_invalidate(license_id=license_id)
         
-        cursor.execute("""
-            INSERT INTO usage_logs 
-            (license_key, action, timestamp)
-            VALUES (?, ?, ?)
-        """, (license_id[:8], "generation_used", datetime.now().isoformat()))
+        if charged:
+            self.usage_log.log("generation_used", license_key=license_id[:8], timestamp=now)
+            return True, f"Использовано генераций: {used}/{monthly_limit}"
+        if not is_active:
+            return False, "Неверный лицензионный ключ"
+        if expiry_date and now > datetime.fromisoformat(expiry_date):
+            return False, "Срок действия лицензии истек"
+        return False, f"Достигнут лимит генераций ({monthly_limit}/месяц)"
+    
+    def revoke_license(self, license_id):
+        """Отозвать лицензию (для администратора)"""
+        with self._connection() as conn:
+            revoked = conn.execute("""
+                UPDATE licenses 
+                SET is_active = 0
+                WHERE id = ?
+            """, (license_id,)).rowcount > 0
         
-        conn.commit()
-        conn.close()
+        self._cache_invalidate(license_id=license_id)
         
-        return True, f"Использовано генераций: {used + 1}/{monthly_limit}"
+        if not revoked:
+            return False, "Лицензия не найдена"
+        return True, "Лицензия отозвана"
+    
+    def get_usage_summary(self, days=30):
+        """Действия по лицензиям за последние дни (из дневных итогов, для администратора)"""
+        since = (datetime.now() - timedelta(days=days)).date().isoformat()
+        # Если очередь журнала не удалось сохранить (база занята), итоги не включают
+        # последние действия; причина - в usage_log.last_error
+        self.usage_log.flush(timeout=5)
+        with self._connection() as conn:
+            results = conn.execute("""
+                SELECT day, license_key, action, count FROM usage_daily
+                WHERE day >= ?
+                ORDER BY day, license_key, action
+            """, (since,)).fetchall()
+        
+        return [
+            {"day": day, "license": license_key or None, "action": action, "count": count}
+            for day, license_key, action, count in results
+        ]
     
     def get_all_licenses(self):
         """Получить все лицензии (для администратора)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM licenses WHERE is_active = 1")
-        results = cursor.fetchall()
-        
-        conn.close()
+        with self._connection() as conn:
+            results = conn.execute("SELECT * FROM licenses WHERE is_active = 1").fetchall()
         
         licenses = []
         for row in results:
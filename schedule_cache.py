@@ -0,0 +1,166 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class ScheduleCache:
+    """Кэш готовых расписаний по отпечатку входных данных
+
+    Значения хранятся в сериализованном виде (pickle): размер записи известен
+    точно, а каждый get возвращает независимую копию, которую можно править
+    в своей сессии. Вытеснение - по давности использования (LRU) при
+    превышении числа записей или суммарного размера. Если задан persist_dir,
+    записи дублируются файлами и переживают перезапуск приложения.
+    Все операции защищены блокировкой, поэтому один кэш можно разделять
+    между сессиями.
+    """
+
+    FILE_SUFFIX = ".pkl"
+
+    def __init__(self, max_entries: int = 32, max_bytes: int = 64 * 1024 * 1024,
+                 persist_dir: Optional[str] = None):
+        if max_entries < 1 or max_bytes < 1:
+            raise ValueError("Размер кэша должен быть положительным")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.persist_dir = persist_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+            self._load_persisted()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Копия значения по ключу или None"""
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if self.persist_dir:
+                self._touch_file(key)
+        try:
+            return pickle.loads(payload)
+        except Exception:
+            # Поврежденный файл или несовместимая версия классов - считаем промахом
+            with self._lock:
+                self._discard(key)
+                self.hits -= 1
+                self.misses += 1
+            return None
+
+    def put(self, key: str, value: Any) -> bool:
+        """Сохранить значение; False, если оно больше всего кэша"""
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            return False
+
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = payload
+            self._size += len(payload)
+            if self.persist_dir:
+                self._write_file(key, payload)
+            self._evict()
+        return True
+
+    def clear(self):
+        """Удалить все записи (и файлы, если кэш сохраняется на диск)"""
+        with self._lock:
+            for key in list(self._entries):
+                self._discard(key)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get_statistics(self) -> dict:
+        """Число записей, занятый объем и попадания"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def _discard(self, key: str):
+        """Удалить запись из памяти и с диска (вызывается под блокировкой)"""
+        payload = self._entries.pop(key, None)
+        if payload is not None:
+            self._size -= len(payload)
+        if self.persist_dir:
+            try:
+                os.remove(self._file_path(key))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """Вытеснить самые давние записи до соблюдения лимитов"""
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._discard(oldest)
+
+    def _file_path(self, key: str) -> str:
+        return os.path.join(self.persist_dir, key + self.FILE_SUFFIX)
+
+    def _write_file(self, key: str, payload: bytes):
+        """Атомарная запись: читатель не увидит недописанный файл"""
+        path = self._file_path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(payload)
+            os.replace(temp_path, path)
+        except OSError:
+            # Кэш на диске необязателен: запись остается в памяти
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def _touch_file(self, key: str):
+        """Время изменения файла отражает последнее использование (порядок LRU после перезапуска)"""
+        try:
+            os.utime(self._file_path(key))
+        except OSError:
+            pass
+
+    def _load_persisted(self):
+        """Загрузить сохраненные записи в порядке использования; не поместившиеся файлы удаляются"""
+        files = []
+        for name in os.listdir(self.persist_dir):
+            if not name.endswith(self.FILE_SUFFIX):
+                continue
+            path = os.path.join(self.persist_dir, name)
+            try:
+                files.append((os.path.getmtime(path), name[:-len(self.FILE_SUFFIX)]))
+            except OSError:
+                continue
+
+        # Добавляем от старых к новым, чтобы порядок LRU соответствовал времени записи
+        files.sort()
+        for _, key in files:
+            try:
+                with open(self._file_path(key), 'rb') as file:
+                    payload = file.read()
+            except OSError:
+                continue
+            if len(payload) > self.max_bytes:
+                self._discard(key)
+                continue
+            self._entries[key] = payload
+            self._size += len(payload)
+            self._evict()
@@ -0,0 +1,119 @@
+import io
+import json
+from datetime import date
+from typing import BinaryIO, Dict, List, Union
+
+from scheduler import DAILY_SHIFT_TYPES, ShiftScheduler
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow нужен только для Parquet и Arrow
+    pa = None
+
+# Форматы длинной выгрузки: одна строка на наряд
+EXPORT_FORMATS = ('parquet', 'arrow', 'jsonl')
+
+# Столбцы выгрузки в порядке записи
+RECORD_COLUMNS = ['date', 'end_date', 'shift_type', 'employee_id', 'employee_name', 'status', 'reason']
+
+# Порядковый номер 01.01.1970 - начало отсчета дат Arrow (date32)
+_EPOCH_DAY = date(1970, 1, 1).toordinal()
+
+
+def collect_shift_records(scheduler: ShiftScheduler) -> Dict[str, List]:
+    """Снимок расписания в длинном формате без построения календарной сетки
+
+    Сначала назначенные наряды, затем нераспределенные (status 'unassigned'
+    и причина из unassigned_reasons). Даты - порядковые номера дней, как
+    во внутренних структурах планировщика; в дату они переводятся при записи.
+    """
+    records = {column: [] for column in RECORD_COLUMNS}
+    names = {employee.id: employee.name for employee in scheduler.employees}
+
+    for status, shifts in (('assigned', scheduler.assigned_shifts), ('unassigned', scheduler.unassigned_shifts)):
+        for shift in shifts:
+            records['date'].append(shift.day)
+            records['end_date'].append(shift.day + 1 if shift.type in DAILY_SHIFT_TYPES else shift.day)
+            records['shift_type'].append(shift.type)
+            records['employee_id'].append(shift.employee_id)
+            records['employee_name'].append(names.get(shift.employee_id))
+            records['status'].append(status)
+            records['reason'].append(scheduler.get_unassigned_reason(shift) if status == 'unassigned' else None)
+
+    return records
+
+
+def to_arrow_table(records: Dict[str, List]) -> "pa.Table":
+    """Таблица Arrow: даты - date32, повторяющиеся строки - словарное кодирование"""
+    if pa is None:
+        raise ImportError("Для выгрузки в Parquet/Arrow требуется пакет pyarrow")
+
+    def dictionary(values):
+        return pa.array(values, type=pa.string()).dictionary_encode()
+
+    return pa.table({
+        'date': pa.array([day - _EPOCH_DAY for day in records['date']], type=pa.int32()).cast(pa.date32()),
+        'end_date': pa.array([day - _EPOCH_DAY for day in records['end_date']], type=pa.int32()).cast(pa.date32()),
+        'shift_type': pa.array(records['shift_type'], type=pa.int8()),
+        'employee_id': pa.array(records['employee_id'], type=pa.int32()),
+        'employee_name': dictionary(records['employee_name']),
+        'status': dictionary(records['status']),
+        'reason': dictionary(records['reason'])
+    })
+
+
+def write_records(records: Dict[str, List], destination: Union[str, BinaryIO], fmt: str):
+    """Записать снимок в файл (путь или двоичный поток) в формате fmt"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+
+    if fmt == 'jsonl':
+        if isinstance(destination, str):
+            with open(destination, 'wb') as file:
+                _write_jsonl(records, file)
+        else:
+            _write_jsonl(records, destination)
+        return
+
+    table = to_arrow_table(records)
+    if fmt == 'parquet':
+        pq.write_table(table, destination, compression='zstd')
+    else:
+        feather.write_feather(table, destination, compression='zstd')
+
+
+def records_to_bytes(records: Dict[str, List], fmt: str) -> bytes:
+    """Снимок в виде содержимого файла (для скачивания)"""
+    output = io.BytesIO()
+    write_records(records, output, fmt)
+    return output.getvalue()
+
+
+def export_schedule(scheduler: ShiftScheduler, destination: Union[str, BinaryIO], fmt: str = 'parquet'):
+    """Выгрузить расписание в длинном формате (Parquet, Arrow IPC или JSON Lines)"""
+    write_records(collect_shift_records(scheduler), destination, fmt)
+
+
+def _write_jsonl(records: Dict[str, List], file: BinaryIO):
+    """JSON Lines: одна строка на наряд, даты в ISO 8601"""
+    iso_dates = {}
+
+    def iso(day):
+        if day not in iso_dates:
+            iso_dates[day] = date.fromordinal(day).isoformat()
+        return iso_dates[day]
+
+    columns = [records[column] for column in RECORD_COLUMNS]
+    for date_day, end_day, shift_type, employee_id, employee_name, status, reason in zip(*columns):
+        line = json.dumps({
+            'date': iso(date_day),
+            'end_date': iso(end_day),
+            'shift_type': shift_type,
+            'employee_id': employee_id,
+            'employee_name': employee_name,
+            'status': status,
+            'reason': reason
+        }, ensure_ascii=False)
+        file.write(line.encode('utf-8') + b'\n')
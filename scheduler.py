@@ -1,37 +1,311 @@
-from datetime import datetime, timedelta
-from collections import defaultdict
-from typing import List, Dict, Optional
+import os
+import time
+import hashlib
+import json
+import tempfile
+import warnings
+from datetime import datetime
+from collections import defaultdict, deque
+from bisect import bisect_left, insort
+import heapq
+from typing import List, Dict, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy нужен только для векторизованного режима
+    np = None
+
+# Суточные наряды (с 9:00 до 9:00 следующего дня)
+DAILY_SHIFT_TYPES = frozenset({1, 2, 3, 4, 5, 6})
+
+# Версия формата отпечатка входных данных: меняется вместе с алгоритмом распределения
+# и составом сохраняемого состояния планировщика
+FINGERPRINT_VERSION = 5
+
+# Подготовка модели внутри scipy (перевод в структуры HiGHS, разбор решения) не входит
+# в time_limit решателя и растет с числом переменных. Стоимость на переменную измеряется
+# один раз на процесс (milp_setup_cost) и не бывает меньше этого значения
+MILP_SETUP_SECONDS_PER_VARIABLE = 3e-6
+# Модель строится, только если ее подготовка займет не больше этой доли оставшегося времени
+MILP_SETUP_BUDGET_SHARE = 0.5
+
+_milp_setup_cost: Optional[float] = None
+
+def milp_setup_cost() -> float:
+    """Секунды подготовки модели в scipy.optimize.milp на одну переменную
+    
+    Измеряется на небольшой модели той же структуры (строки нарядов, пар
+    сотрудник-день и лимитов; запас 25%) и уточняется по фактическим запускам
+    с остановкой по времени (_solve_milp).
+    """
+    global _milp_setup_cost
+    if _milp_setup_cost is None:
+        from scipy.optimize import milp, LinearConstraint, Bounds
+        from scipy.sparse import csr_matrix
+        # 50 сотрудников, 1000 суточных нарядов по 30 в день
+        n, employees, shifts = 50_000, 50, 1000
+        days = shifts // 30 + 2
+        var = np.arange(n)
+        shift, employee = var // employees, var % employees
+        day = shift // 30
+        rows = np.concatenate([shift, shifts + employee * days + day, shifts + employee * days + day + 1,
+                               shifts + employees * days + employee])
+        used_rows, rows = np.unique(rows, return_inverse=True)
+        matrix = csr_matrix((np.ones(len(rows)), (rows, np.tile(var, 4))), shape=(len(used_rows), n))
+        upper = np.where(used_rows >= shifts + employees * days, 15.0, 1.0)
+        started = time.monotonic()
+        milp(-np.ones(n), constraints=LinearConstraint(matrix, -np.inf, upper), integrality=np.ones(n),
+             bounds=Bounds(0, 1), options={'time_limit': 0.01})
+        _milp_setup_cost = max(MILP_SETUP_SECONDS_PER_VARIABLE, 1.25 * (time.monotonic() - started) / n)
+    return _milp_setup_cost
+
+def record_milp_setup_cost(seconds_per_variable: float):
+    """Учесть накладные расходы, замеренные на настоящей модели (оценка только растет)"""
+    global _milp_setup_cost
+    _milp_setup_cost = max(milp_setup_cost(), seconds_per_variable)
+
+def to_day(date: datetime) -> int:
+    """Порядковый номер дня для даты (на границе с интерфейсом)"""
+    return date.toordinal()
+
+def from_day(day: int) -> datetime:
+    """Дата (полночь) по порядковому номеру дня"""
+    return datetime.fromordinal(day)
+
+class DaySet:
+    """Компактное множество порядковых номеров дней: битовая маска от первого дня
+    
+    Поддерживает операции множества, которые нужны планировщику (in, isdisjoint,
+    update, difference_update, len, перебор). Занимает десятки байт вместо
+    хэш-таблицы с отдельным объектом int на каждый день.
+    """
+    __slots__ = ('base', 'mask')
+    __hash__ = None
+    
+    def __init__(self, days=()):
+        self.base = 0
+        self.mask = 0
+        self.update(days)
+    
+    def __contains__(self, day: int) -> bool:
+        offset = day - self.base
+        return offset >= 0 and (self.mask >> offset) & 1 == 1
+    
+    def __iter__(self):
+        mask, base = self.mask, self.base
+        while mask:
+            low = mask & -mask
+            yield base + low.bit_length() - 1
+            mask ^= low
+    
+    def __len__(self) -> int:
+        return bin(self.mask).count('1')
+    
+    def __bool__(self) -> bool:
+        return self.mask != 0
+    
+    def __eq__(self, other) -> bool:
+        if isinstance(other, DaySet):
+            return self.base == other.base and self.mask == other.mask
+        return set(self) == set(other)
+    
+    def __repr__(self) -> str:
+        return f"DaySet({sorted(self)})"
+    
+    def isdisjoint(self, days) -> bool:
+        mask, base = self.mask, self.base
+        for day in days:
+            offset = day - base
+            if offset >= 0 and (mask >> offset) & 1:
+                return False
+        return True
+    
+    def add(self, day: int):
+        self.update((day,))
+    
+    def update(self, days):
+        for day in days:
+            if not self.mask:
+                self.base, self.mask = day, 1
+            elif day < self.base:
+                self.mask = (self.mask << (self.base - day)) | 1
+                self.base = day
+            else:
+                self.mask |= 1 << (day - self.base)
+    
+    def difference_update(self, days):
+        for day in days:
+            offset = day - self.base
+            if offset >= 0:
+                self.mask &= ~(1 << offset)
+        # Нормализуем: младший бит маски соответствует первому дню
+        if self.mask:
+            shift = (self.mask & -self.mask).bit_length() - 1
+            self.mask >>= shift
+            self.base += shift
+        else:
+            self.base = 0
 
 class Employee:
     """Класс для представления сотрудника"""
+    __slots__ = ('id', 'name', 'priority', 'vacation_days', 'preferred_exclusion_days',
+                 'vacation_ordinals', 'exclusion_ordinals')
+    
     def __init__(self, id: int, name: str, priority: int = 0):
         self.id = id
         self.name = name
         self.priority = priority
         self.vacation_days: List[datetime] = []
         self.preferred_exclusion_days: List[datetime] = []
+        # Индексы дней (порядковые номера дат) для проверок за O(1)
+        self.vacation_ordinals = DaySet()
+        self.exclusion_ordinals = DaySet()
+
+    def build_day_index(self):
+        """Построение индексов дней отпуска и нежелательных дат"""
+        self.vacation_ordinals = DaySet(to_day(day) for day in self.vacation_days)
+        self.exclusion_ordinals = DaySet(to_day(day) for day in self.preferred_exclusion_days)
 
 class Shift:
-    """Класс для представления наряда"""
+    """Класс для представления наряда
+    
+    Хранит порядковый номер дня (day), а не datetime; date и end_date
+    вычисляются при обращении со стороны интерфейса.
+    """
+    __slots__ = ('day', 'type', 'employee_id')
+    
     def __init__(self, date: datetime, shift_type: int, employee_id: Optional[int] = None):
-        self.date = date
+        self.day = to_day(date)
         self.type = shift_type
         self.employee_id = employee_id
+    
+    @property
+    def date(self) -> datetime:
+        return from_day(self.day)
+    
+    @property
+    def end_date(self) -> datetime:
         # Наряды типа 1-6 заканчиваются на следующий день в 9:00
         # Наряд типа 7 (8 часов) заканчивается в тот же день
-        self.end_date = date + timedelta(days=1) if shift_type in [1, 2, 3, 4, 5, 6] else date
+        return from_day(self.day + 1) if self.type in DAILY_SHIFT_TYPES else self.date
+
+class ShiftList:
+    """Список нарядов с удалением за O(1)
+    
+    Наряды хранятся ключами словаря в порядке добавления, поэтому remove
+    не сдвигает остальные элементы. Порядок такой же, как у list: remove
+    и повторный append переносят наряд в конец.
+    """
+    __slots__ = ('_shifts',)
+    
+    def __init__(self, shifts=()):
+        self._shifts = dict.fromkeys(shifts)
+    
+    def __iter__(self):
+        return iter(self._shifts)
+    
+    def __len__(self) -> int:
+        return len(self._shifts)
+    
+    def __bool__(self) -> bool:
+        return bool(self._shifts)
+    
+    def __contains__(self, shift) -> bool:
+        return shift in self._shifts
+    
+    def __repr__(self) -> str:
+        return f"ShiftList({list(self._shifts)!r})"
+    
+    def append(self, shift: Shift):
+        self._shifts[shift] = None
+    
+    def extend(self, shifts):
+        self._shifts.update(dict.fromkeys(shifts))
+    
+    def remove(self, shift: Shift):
+        try:
+            del self._shifts[shift]
+        except KeyError:
+            raise ValueError("Наряд не найден в списке") from None
+    
+    def sort(self, key=None):
+        self._shifts = dict.fromkeys(sorted(self._shifts, key=key))
+
+class CandidateQueue:
+    """Очередь кандидатов, упорядоченная по (-приоритет, число нарядов, порядок добавления)
+    
+    Порядок совпадает с устойчивой сортировкой списка сотрудников по
+    (-priority, shifts_count). После назначения переставляется только
+    один элемент, поэтому полная сортировка на каждый наряд не нужна.
+    """
+    def __init__(self, employees: List[Employee], employee_stats: Dict):
+        self.employees = employees
+        self._positions = {employee.id: index for index, employee in enumerate(employees)}
+        self._counts = [employee_stats[employee.id]['shifts_count'] for employee in employees]
+        self._entries = sorted(
+            (-employee.priority, self._counts[index], index)
+            for index, employee in enumerate(employees)
+        )
+    
+    def __iter__(self):
+        """Сотрудники в порядке предпочтения"""
+        employees = self.employees
+        for _, _, index in self._entries:
+            yield employees[index]
+    
+    def update(self, employee: Employee, shifts_count: int):
+        """Переставить сотрудника после изменения числа его нарядов"""
+        index = self._positions[employee.id]
+        position = bisect_left(self._entries, (-employee.priority, self._counts[index], index))
+        del self._entries[position]
+        self._counts[index] = shifts_count
+        insort(self._entries, (-employee.priority, shifts_count, index))
+    
+    def group(self, priority: int) -> List[Employee]:
+        """Сотрудники одного приоритета по возрастанию числа нарядов"""
+        start = bisect_left(self._entries, (-priority,))
+        end = bisect_left(self._entries, (-priority + 1,))
+        return [self.employees[index] for _, _, index in self._entries[start:end]]
+
+def new_employee_stats() -> Dict:
+    """Начальная статистика сотрудника (функция модуля, чтобы планировщик сериализовался pickle)"""
+    return {
+        'shifts_count': 0, 
+        'occupied_days': DaySet(), 
+        'day_shifts': {},  # занятый день -> наряд, который его занимает
+        'monthly_slots': 15
+    }
 
 class ShiftScheduler:
     """Основной класс для распределения нарядов"""
     def __init__(self):
         self.employees: List[Employee] = []
-        self.assigned_shifts: List[Shift] = []
-        self.unassigned_shifts: List[Shift] = []
-        self.employee_stats = defaultdict(lambda: {
-            'shifts_count': 0, 
-            'occupied_days': set(), 
-            'monthly_slots': 15
-        })
+        self.assigned_shifts = ShiftList()
+        self.unassigned_shifts = ShiftList()
+        self.employee_stats = defaultdict(new_employee_stats)
+        # Индексы: назначенные наряды сотрудника (поддерживается при назначениях и правках),
+        # все наряды по дате (даты нарядов при правках не меняются), сотрудники по id и ФИО
+        self.shifts_by_employee: Dict[int, List[Shift]] = defaultdict(list)
+        self.shifts_by_date: Dict[datetime, List[Shift]] = {}
+        self.employee_by_id: Dict[int, Employee] = {}
+        self.employee_by_name: Dict[str, Employee] = {}
+        # Причины нераспределенных нарядов, зафиксированные в момент неудачи
+        self.unassigned_reasons: Dict[Shift, Dict] = {}
+        # Составляющие отпечатка состояния: входные данные и XOR хэшей назначений
+        self._input_key = ""
+        self._assignment_hash = 0
+        # Наряды на нежелательных датах исполнителя (упорядоченное множество), обновляется
+        # при каждом назначении и снятии; порядок загрузки сотрудников - только во время
+        # улучшения (improve_schedule), тоже обновляется при назначениях
+        self._exclusion_violations: Dict[Shift, None] = {}
+        self._load_order: Optional[CandidateQueue] = None
+        # Неудачные поиски замены во время улучшения: ключ (день, суточный) -> хэш назначений
+        self._failed_relocations: Optional[Dict[Tuple[int, bool], int]] = None
+        # Журнал правок: каждая запись - список (наряд, прежний id, новый id, прежняя причина
+        # нераспределения, причина после правки), чтобы отмена и повтор восстанавливали
+        # причины без повторной диагностики и работали за O(1) на изменение
+        self._undo_stack: List[List[Tuple[Shift, Optional[int], Optional[int], Optional[Dict], Optional[Dict]]]] = []
+        self._redo_stack: List[List[Tuple[Shift, Optional[int], Optional[int], Optional[Dict], Optional[Dict]]]] = []
     
     def add_employee(self, name: str, vacation_days: List[datetime] = None, 
                      preferred_exclusion_days: List[datetime] = None, priority: int = 0) -> int:
@@ -42,141 +316,1241 @@ class ShiftScheduler:
             employee.vacation_days = vacation_days
         if preferred_exclusion_days:
             employee.preferred_exclusion_days = preferred_exclusion_days
+        employee.build_day_index()
         self.employees.append(employee)
+        self.employee_by_id[employee_id] = employee
+        self.employee_by_name.setdefault(name, employee)
         return employee_id
 
-    def generate_schedule(self, daily_shifts: Dict[datetime, List[int]]):
-        """Распределение нарядов с учетом всех ограничений"""
-        self.assigned_shifts = []
-        self.unassigned_shifts = []
+    def input_fingerprint(self, daily_shifts: Dict[datetime, List[int]], **options) -> str:
+        """Отпечаток входных данных генерации (sha256)
+        
+        Учитываются наряды по датам (порядок типов внутри дня важен), сотрудники
+        в порядке добавления с отпусками, нежелательными датами и приоритетом,
+        а также параметры генерации (options). Одинаковые входные данные дают
+        одинаковое расписание, поэтому отпечаток служит ключом кэша.
+        """
+        canonical = {
+            'version': FINGERPRINT_VERSION,
+            'shifts': sorted(
+                (to_day(date), list(shift_types)) for date, shift_types in daily_shifts.items()
+            ),
+            'employees': [
+                (
+                    employee.name,
+                    sorted({to_day(day) for day in employee.vacation_days}),
+                    sorted({to_day(day) for day in employee.preferred_exclusion_days}),
+                    employee.priority
+                )
+                for employee in self.employees
+            ],
+            'options': options
+        }
+        payload = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    @property
+    def schedule_fingerprint(self) -> str:
+        """Отпечаток текущего состояния расписания (ключ кэша производных таблиц и графиков)
+        
+        Меняется при любой генерации и правке; после отмены правки возвращается
+        прежнее значение. Назначения учитываются XOR-хэшем, который обновляется
+        при каждом назначении и снятии наряда, поэтому вычисление не зависит
+        от числа назначенных нарядов. Нераспределенные наряды учитываются без
+        учета порядка в списке (отмена возвращает наряд в конец списка).
+        """
+        unassigned = sorted(
+            (shift.day, shift.type, tuple(sorted(self.unassigned_reasons.get(shift, {}).items())))
+            for shift in self.unassigned_shifts
+        )
+        payload = f"{self._input_key}:{self._assignment_hash}:{unassigned!r}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def generate_schedule(self, daily_shifts: Dict[datetime, List[int]], engine: str = "python",
+                          ordering: str = "date"):
+        """Распределение нарядов с учетом всех ограничений
         
-        # Сбрасываем статистику сотрудников
+        engine: "python" - перебор сотрудников для каждого наряда,
+                "numpy" - векторизованная матрица доступности (сотрудники × дни).
+        Оба режима дают одинаковый результат; без numpy используется "python".
+        
+        ordering: "date" - наряды распределяются по порядку дат,
+                  "constrained" - первым распределяется наряд с наименьшим
+                  числом подходящих сотрудников (engine не используется).
+        """
+        if engine not in ("python", "numpy"):
+            raise ValueError(f"Неизвестный режим распределения: {engine}")
+        if ordering not in ("date", "constrained"):
+            raise ValueError(f"Неизвестный порядок распределения: {ordering}")
+        
+        all_shifts = self._prepare_shifts(daily_shifts)
+        
+        if ordering == "constrained":
+            self._distribute_constrained(all_shifts)
+        elif engine == "numpy" and np is not None:
+            self._distribute_vectorized(all_shifts)
+        else:
+            self._distribute(all_shifts)
+    
+    def _prepare_shifts(self, daily_shifts: Dict[datetime, List[int]]) -> List[Shift]:
+        """Сброс результатов и статистики, создание списка нарядов в порядке дат"""
+        self.assigned_shifts = ShiftList()
+        self.unassigned_shifts = ShiftList()
+        self.unassigned_reasons = {}
+        self._assignment_hash = 0
+        self._exclusion_violations = {}
+        self._input_key = self.input_fingerprint(daily_shifts)
+        self.clear_history()
+        
+        # Сбрасываем статистику сотрудников и перестраиваем индексы дней
         for employee in self.employees:
-            self.employee_stats[employee.id] = {
-                'shifts_count': 0, 
-                'occupied_days': set(), 
-                'monthly_slots': 15
-            }
+            employee.build_day_index()
+            self._reset_employee_stats(employee)
         
         # Создаем список всех нарядов для распределения
         all_shifts = []
+        self.shifts_by_date = {}
         for date, shift_types in daily_shifts.items():
-            for shift_type in shift_types:
-                all_shifts.append(Shift(date, shift_type))
+            date_shifts = [Shift(date, shift_type) for shift_type in shift_types]
+            self.shifts_by_date.setdefault(date, []).extend(date_shifts)
+            all_shifts.extend(date_shifts)
         
         # Сортируем наряды по дате для последовательного распределения
-        all_shifts.sort(key=lambda x: x.date)
+        all_shifts.sort(key=lambda x: x.day)
+        return all_shifts
+    
+    def _reset_employee_stats(self, employee: Employee):
+        """Сброс статистики сотрудника (occupied_days - порядковые номера дней)"""
+        self.employee_stats[employee.id] = new_employee_stats()
+        self.shifts_by_employee[employee.id] = []
+    
+    def generate_optimal_schedule(self, daily_shifts: Dict[datetime, List[int]],
+                                  time_limit: float = 10.0, max_variables: int = 1_000_000) -> Dict:
+        """Распределение с минимальным числом нераспределенных нарядов
         
-        # Распределяем наряды
-        for shift in all_shifts:
-            available_employees = self._get_available_employees(shift)
+        Сначала выполняется жадное распределение, затем задача решается точно
+        как целочисленная программа (scipy.optimize.milp): каждый наряд не более
+        одному сотруднику, не более одного наряда на сотрудника в каждый занятый
+        день (суточный наряд занимает два дня), без отпусков и не более 15
+        суточных нарядов на сотрудника. Нежелательные даты и приоритет учитываются
+        как второстепенные цели. Если scipy недоступен, время истекло или решение
+        не лучше жадного, остается жадный результат.
+
+        Жадное решение передается решателю как начальное. Размер модели
+        оценивается до построения: если ее подготовка не укладывается в половину
+        лимита времени или переменных больше max_variables, решатель не
+        запускается. Выше миллиона переменных HiGHS тратит на начальную
+        обработку модели больше времени, чем позволяет лимит.
+        
+        Возвращает отчет: использованный метод, статус, число нераспределенных
+        у жадного и итогового решения, выигрыш и нижнюю оценку.
+        """
+        started = time.monotonic()
+        all_shifts = self._prepare_shifts(daily_shifts)
+        if np is not None:
+            self._distribute_vectorized(all_shifts)
+        else:
+            self._distribute(all_shifts)
+        
+        greedy_unassigned = len(self.unassigned_shifts)
+        report = {
+            'solver': 'greedy',
+            'status': '',
+            'greedy_unassigned': greedy_unassigned,
+            'unassigned': greedy_unassigned,
+            'gap': 0,
+            'lower_bound': None,
+            'elapsed': 0.0
+        }
+        
+        if greedy_unassigned == 0:
+            report['status'] = 'Жадное распределение покрывает все наряды'
+            report['lower_bound'] = 0
+        else:
+            self._solve_milp(all_shifts, report, started + time_limit, max_variables)
+        
+        report['elapsed'] = time.monotonic() - started
+        return report
+    
+    def _solve_milp(self, all_shifts: List[Shift], report: Dict, deadline: float, max_variables: int):
+        """Точное решение задачи назначения, результат применяется только при улучшении"""
+        try:
+            from scipy.optimize import milp, LinearConstraint, Bounds
+            from scipy.sparse import csr_matrix
+        except ImportError:
+            report['status'] = 'scipy не установлен, использовано жадное распределение'
+            return
+        if np is None or not self.employees:
+            report['status'] = 'Нет данных для оптимизации, использовано жадное распределение'
+            return
+        
+        first_day = all_shifts[0].day
+        num_days = all_shifts[-1].day - first_day + 2
+        num_employees = len(self.employees)
+        num_shifts = len(all_shifts)
+        
+        vacation, exclusion = self._day_masks(first_day, num_days)
+        shift_rows = np.array([shift.day - first_day for shift in all_shifts], dtype=np.int64)
+        shift_daily = np.array([shift.type in DAILY_SHIFT_TYPES for shift in all_shifts], dtype=bool)
+        
+        # Размер модели известен до построения: число сотрудников не в отпуске
+        # в день наряда (для суточного - в оба дня)
+        available = (~vacation).sum(axis=1)
+        available_both = (~(vacation[:-1] | vacation[1:])).sum(axis=1)
+        num_vars = int(np.where(shift_daily, available_both[shift_rows], available[shift_rows]).sum())
+        if not num_vars:
+            report['status'] = 'Все сотрудники в отпуске, использовано жадное распределение'
+            return
+        if num_vars > max_variables:
+            report['status'] = f'Слишком большая задача (более {max_variables} переменных), использовано жадное распределение'
+            return
+        # Если подготовка модели съест большую часть лимита, решателю не останется времени
+        setup_estimate = num_vars * milp_setup_cost()
+        if setup_estimate > MILP_SETUP_BUDGET_SHARE * (deadline - time.monotonic()):
+            report['status'] = (f'Задача слишком велика для лимита времени ({num_vars} переменных, '
+                                f'подготовка около {setup_estimate:.1f} с), использовано жадное распределение')
+            return
+        
+        # Переменная x[s, e] = 1, если наряд s назначен сотруднику e;
+        # создаются только пары, где сотрудник не в отпуске. Маски строятся
+        # блоками нарядов, между блоками проверяется лимит времени
+        chunk = max(1, 1_000_000 // num_employees)
+        var_shift, var_employee, var_excluded = [], [], []
+        for start in range(0, num_shifts, chunk):
+            if time.monotonic() >= deadline:
+                report['status'] = 'Время истекло при построении модели, использовано жадное распределение'
+                return
+            rows = shift_rows[start:start + chunk]
+            daily = shift_daily[start:start + chunk, None]
+            on_vacation = vacation[rows] | (vacation[rows + 1] & daily)
+            excluded = exclusion[rows] | (exclusion[rows + 1] & daily)
+            shift_index, employee_index = np.nonzero(~on_vacation)
+            var_shift.append(shift_index + start)
+            var_employee.append(employee_index)
+            var_excluded.append(excluded[shift_index, employee_index])
+        
+        # Переменные упорядочены по наряду, затем по сотруднику
+        var_shift = np.concatenate(var_shift)
+        var_employee = np.concatenate(var_employee)
+        var_excluded = np.concatenate(var_excluded)
+        
+        var_day = shift_rows[var_shift]
+        var_daily = shift_daily[var_shift]
+        
+        # Строки ограничений: наряды, затем пары (сотрудник, день), затем лимиты слотов
+        day_offset = num_shifts
+        limit_offset = day_offset + num_employees * num_days
+        var_index = np.arange(num_vars)
+        second_day = var_index[var_daily]
+        rows = np.concatenate([
+            var_shift,
+            day_offset + var_employee * num_days + var_day,
+            day_offset + var_employee[second_day] * num_days + var_day[second_day] + 1,
+            limit_offset + var_employee[second_day]
+        ])
+        cols = np.concatenate([var_index, var_index, second_day, second_day])
+        
+        # Убираем пустые строки, чтобы не раздувать модель
+        used_rows, rows = np.unique(rows, return_inverse=True)
+        matrix = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(used_rows), num_vars))
+        upper = np.where(used_rows >= limit_offset, 15.0, 1.0)
+        
+        # Целевая функция: максимум назначенных нарядов; штраф за нежелательные даты
+        # и бонус за приоритет меньше единицы в сумме и не меняют число назначенных
+        priority = np.array([employee.priority for employee in self.employees], dtype=float)
+        scale = 1.0 / (num_shifts + 1)
+        cost = -np.ones(num_vars)
+        cost += 0.5 * scale * var_excluded
+        if priority.max() > 0:
+            cost -= 0.25 * scale * priority[var_employee] / priority.max()
+        
+        time_left = deadline - time.monotonic() - num_vars * milp_setup_cost()
+        if time_left <= 0:
+            report['status'] = 'Время истекло при построении модели, использовано жадное распределение'
+            return
+        
+        # Жадное решение передается решателю как начальное: при остановке по времени
+        # результат не хуже жадного
+        start_file = self._write_milp_start(all_shifts, var_shift, var_employee, cost)
+        try:
+            with warnings.catch_warnings():
+                # read_solution_file scipy передает в HiGHS как есть, с предупреждением
+                warnings.filterwarnings('ignore', message='Unrecognized options')
+                solve_started = time.monotonic()
+                result = milp(
+                    cost,
+                    constraints=LinearConstraint(matrix, -np.inf, upper),
+                    integrality=np.ones(num_vars),
+                    bounds=Bounds(0, 1),
+                    options={'time_limit': time_left, 'disp': False, 'read_solution_file': start_file}
+                )
+        finally:
+            os.remove(start_file)
+        
+        # Остановка по времени показывает фактические накладные расходы scipy
+        if result.status == 1:
+            record_milp_setup_cost((time.monotonic() - solve_started - time_left) / num_vars)
+        
+        dual_bound = getattr(result, 'mip_dual_bound', None)
+        if dual_bound is not None and np.isfinite(dual_bound):
+            max_assigned = min(num_shifts, int(np.floor(-dual_bound + 0.5 + 1e-6)))
+            report['lower_bound'] = num_shifts - max_assigned
+        
+        if result.x is None:
+            report['status'] = f'Решение не найдено ({result.message}), использовано жадное распределение'
+            return
+        
+        chosen = result.x > 0.5
+        solver_unassigned = num_shifts - int(chosen.sum())
+        if solver_unassigned >= report['greedy_unassigned']:
+            report['status'] = 'Точное решение не лучше жадного, использовано жадное распределение'
+            return
+        
+        # Применяем решение в порядке дат
+        assignment = dict(zip(var_shift[chosen].tolist(), var_employee[chosen].tolist()))
+        self.assigned_shifts = ShiftList()
+        self.unassigned_shifts = ShiftList()
+        self.unassigned_reasons = {}
+        self._assignment_hash = 0
+        self._exclusion_violations = {}
+        for employee in self.employees:
+            self._reset_employee_stats(employee)
+        for index, shift in enumerate(all_shifts):
+            shift.employee_id = None
+            if index in assignment:
+                self._assign_shift(shift, self.employees[assignment[index]])
+            else:
+                self.unassigned_shifts.append(shift)
+        # Решение глобальное, поэтому причины фиксируются по итоговому состоянию
+        for shift in self.unassigned_shifts:
+            self.unassigned_reasons[shift] = self._diagnose(shift)
+        
+        report['solver'] = 'milp'
+        report['status'] = 'Оптимальное решение' if result.status == 0 else 'Лучшее найденное решение (лимит времени)'
+        report['unassigned'] = solver_unassigned
+        report['gap'] = report['greedy_unassigned'] - solver_unassigned
+    
+    def _write_milp_start(self, all_shifts: List[Shift], var_shift, var_employee, cost) -> str:
+        """Файл начального решения HiGHS (разреженный формат) с текущим жадным распределением
+        
+        Переменные упорядочены по наряду, затем по сотруднику, поэтому номер
+        переменной для пары (наряд, сотрудник) находится двоичным поиском.
+        """
+        position = {employee.id: index for index, employee in enumerate(self.employees)}
+        pairs = [(index, position[shift.employee_id]) for index, shift in enumerate(all_shifts)
+                 if shift.employee_id is not None]
+        keys = var_shift * len(self.employees) + var_employee
+        chosen = np.searchsorted(keys, [index * len(self.employees) + employee for index, employee in pairs])
+        
+        fd, path = tempfile.mkstemp(prefix='milp_start_', suffix='.sol')
+        with os.fdopen(fd, 'w') as file:
+            file.write("Model status\nFeasible\n\n# Primal solution values\nFeasible\n")
+            file.write(f"Objective {cost[chosen].sum()!r}\n# Columns -{len(chosen)}\n")
+            file.writelines(f"c{j} 1 {j}\n" for j in chosen.tolist())
+        return path
+    
+    BLOCKER_MESSAGES = {
+        'vacation': "в отпуске в эти дни",
+        'limit': "достиг лимита (15 нарядов)",
+        'busy': "уже занят в эти дни"
+    }
+    
+    def reassign(self, shift: Shift, new_employee_id: Optional[int]) -> Tuple[bool, str]:
+        """Переназначить наряд сотруднику (None - снять назначение)
+        
+        Ограничения проверяются до изменений; при нарушении расписание не меняется.
+        Статистика обоих сотрудников обновляется вместе с назначением.
+        """
+        if new_employee_id == shift.employee_id:
+            return True, "Назначение не изменилось"
+        
+        if new_employee_id is None:
+            self._record([(shift, None)])
+            return True, "Назначение снято"
+        
+        employee = self.employee_by_id.get(new_employee_id)
+        if employee is None:
+            return False, f"Сотрудник {new_employee_id} не найден"
+        
+        blocker = self._blocker(employee, shift)
+        if blocker:
+            return False, f"Сотрудник {employee.name} {self.BLOCKER_MESSAGES[blocker]}"
+        
+        self._record([(shift, employee.id)])
+        
+        if self._has_exclusion(employee, shift):
+            return True, f"Наряд назначен {employee.name} (нежелательная дата)"
+        return True, f"Наряд назначен {employee.name}"
+    
+    def swap(self, shift_a: Shift, shift_b: Shift) -> Tuple[bool, str]:
+        """Обменять исполнителей двух нарядов
+        
+        Если один из нарядов не назначен, его получает исполнитель другого,
+        а другой наряд становится нераспределенным.
+        """
+        if shift_a is shift_b or shift_a.employee_id == shift_b.employee_id:
+            return True, "Назначение не изменилось"
+        
+        employee_a = self.employee_by_id.get(shift_a.employee_id)
+        employee_b = self.employee_by_id.get(shift_b.employee_id)
+        
+        # Проверяем оба перемещения до изменений
+        for employee, taken, given in ((employee_a, shift_b, shift_a), (employee_b, shift_a, shift_b)):
+            if employee is None:
+                continue
+            blocker = self._blocker(employee, taken, released=given)
+            if blocker:
+                return False, f"Сотрудник {employee.name} {self.BLOCKER_MESSAGES[blocker]}"
+        
+        self._record([(shift_a, shift_b.employee_id), (shift_b, shift_a.employee_id)])
+        return True, "Наряды обменены"
+    
+    def undo(self) -> Tuple[bool, str]:
+        """Отменить последнюю правку"""
+        if not self._undo_stack:
+            return False, "Нечего отменять"
+        entry = self._undo_stack.pop()
+        self._apply_changes(
+            [(shift, old_id) for shift, old_id, _, _, _ in entry],
+            reasons={shift: reason for shift, _, _, reason, _ in entry if reason is not None}
+        )
+        self._redo_stack.append(entry)
+        return True, "Правка отменена"
+    
+    def redo(self) -> Tuple[bool, str]:
+        """Повторить отмененную правку"""
+        if not self._redo_stack:
+            return False, "Нечего повторять"
+        entry = self._redo_stack.pop()
+        self._apply_changes(
+            [(shift, new_id) for shift, _, new_id, _, _ in entry],
+            reasons={shift: reason for shift, _, _, _, reason in entry if reason is not None}
+        )
+        self._undo_stack.append(entry)
+        return True, "Правка повторена"
+    
+    @property
+    def can_undo(self) -> bool:
+        return bool(self._undo_stack)
+    
+    @property
+    def can_redo(self) -> bool:
+        return bool(self._redo_stack)
+    
+    def clear_history(self):
+        """Очистить журнал правок (после перегенерации или изменения ограничений)"""
+        self._undo_stack = []
+        self._redo_stack = []
+    
+    def _record(self, changes: List[Tuple[Shift, Optional[int]]]):
+        """Применить проверенные изменения и записать их в журнал"""
+        old_reasons = [self.unassigned_reasons.get(shift) for shift, _ in changes]
+        old_ids = [shift.employee_id for shift, _ in changes]
+        self._apply_changes(changes)
+        entry = [
+            (shift, old_id, employee_id, old_reason, self.unassigned_reasons.get(shift))
+            for (shift, employee_id), old_id, old_reason in zip(changes, old_ids, old_reasons)
+        ]
+        self._undo_stack.append(entry)
+        self._redo_stack = []
+    
+    def _apply_changes(self, changes: List[Tuple[Shift, Optional[int]]],
+                       reasons: Optional[Dict[Shift, Dict]] = None):
+        """Назначить наряды указанным сотрудникам (None - снять) без проверки ограничений
+        
+        Сначала все наряды снимаются, затем назначаются, чтобы занятые дни
+        не пересекались на промежуточном шаге (например, при обмене в один день).
+        Снятым нарядам причина берется из reasons (при отмене и повторе), иначе вычисляется.
+        """
+        reasons = reasons or {}
+        for shift, employee_id in changes:
+            if shift.employee_id is None:
+                if employee_id is not None:
+                    self.unassigned_shifts.remove(shift)
+                    self.unassigned_reasons.pop(shift, None)
+                    self.assigned_shifts.append(shift)
+            else:
+                self._vacate(shift)
+                if employee_id is None:
+                    self.assigned_shifts.remove(shift)
+                    self.unassigned_shifts.append(shift)
+        
+        for shift, employee_id in changes:
+            if employee_id is not None:
+                self._occupy(shift, self.employee_by_id[employee_id])
+        
+        for shift, employee_id in changes:
+            if employee_id is None:
+                self.unassigned_reasons[shift] = reasons.get(shift) or self._diagnose(shift)
+    
+    def update_employee_constraints(self, employee_id: int, vacation_days: List[datetime] = None,
+                                    preferred_exclusion_days: List[datetime] = None,
+                                    time_limit: float = 1.0, max_iterations: int = 100_000) -> Dict:
+        """Изменить отпуск и/или нежелательные даты сотрудника в готовом расписании
+        
+        Снимаются только наряды, которые теперь попадают на отпуск; они
+        переназначаются локально (напрямую или с переносом мешающего наряда).
+        Наряды на новых нежелательных датах по возможности передаются другим
+        сотрудникам. Если отпуск сократился, нераспределенные наряды на
+        освободившихся днях пробуют отдать этому сотруднику (у остальных
+        доступность не изменилась). Остальное расписание не меняется.
+        Бюджет размещения: time_limit секунд или max_iterations проверок.
+        """
+        employee = self.employee_by_id.get(employee_id)
+        if employee is None:
+            raise ValueError(f"Сотрудник {employee_id} не найден")
+        
+        old_vacation = set(employee.vacation_ordinals)
+        if vacation_days is not None:
+            employee.vacation_days = vacation_days
+        if preferred_exclusion_days is not None:
+            employee.preferred_exclusion_days = preferred_exclusion_days
+        employee.build_day_index()
+        for shift in self.shifts_by_employee[employee.id]:
+            if self._has_exclusion(employee, shift):
+                self._exclusion_violations[shift] = None
+            else:
+                self._exclusion_violations.pop(shift, None)
+        self.clear_history()
+        self._input_key = self.input_fingerprint(
+            {date: [shift.type for shift in shifts] for date, shifts in self.shifts_by_date.items()}
+        )
+        
+        report = {'released': 0, 'reassigned': 0, 'exclusions_moved': 0, 'placed': 0, 'iterations': 0}
+        deadline = time.monotonic() + time_limit
+        def within_budget() -> bool:
+            return report['iterations'] < max_iterations and time.monotonic() < deadline
+        
+        # 1. Снимаем наряды, попавшие на отпуск
+        released = [
+            shift for shift in self.shifts_by_employee[employee.id]
+            if not employee.vacation_ordinals.isdisjoint(self._get_shift_ordinals(shift))
+        ]
+        released_set = set(released)
+        if released:
+            for shift in released:
+                self.assigned_shifts.remove(shift)
+                self._vacate(shift)
+                self.unassigned_shifts.append(shift)
+            report['released'] = len(released)
             
-            if available_employees:
-                # Выбираем сотрудника с учетом приоритета и количества нарядов
-                # Сотрудники с более высоким приоритетом получают наряды в первую очередь
-                available_employees.sort(key=lambda emp: (
-                    -emp.priority,
-                    self.employee_stats[emp.id]['shifts_count']
-                ))
-                employee = available_employees[0]
-                
-                # Назначаем наряд
-                shift.employee_id = employee.id
-                self.assigned_shifts.append(shift)
+            for shift in released:
+                if within_budget() and self._place_unassigned(shift, report):
+                    report['reassigned'] += 1
+                else:
+                    self.unassigned_reasons[shift] = self._diagnose(shift)
+        
+        # 2. Наряды на нежелательных датах передаем, если есть кому
+        for shift in list(self.shifts_by_employee[employee.id]):
+            if within_budget() and self._has_exclusion(employee, shift):
+                target = self._find_relocation(shift, report)
+                if target:
+                    self._vacate(shift)
+                    self._occupy(shift, target)
+                    report['exclusions_moved'] += 1
+        
+        # 3. Освободившиеся от отпуска дни: изменилась доступность только этого сотрудника,
+        # поэтому пробуется он сам и цепочки, где ему передается мешающий наряд.
+        # Результат зависит от ключа (день, суточный), неудача запоминается до изменения расписания
+        freed_days = old_vacation - set(employee.vacation_ordinals)
+        if freed_days:
+            failed_placements = {}
+            for shift in list(self.unassigned_shifts):
+                if not within_budget():
+                    break
+                if shift in released_set or freed_days.isdisjoint(self._get_shift_ordinals(shift)):
+                    continue
+                key = (shift.day, shift.type in DAILY_SHIFT_TYPES)
+                if failed_placements.get(key) == self._assignment_hash:
+                    continue
+                if self._place_with_employee(shift, employee, report):
+                    report['placed'] += 1
+                else:
+                    failed_placements[key] = self._assignment_hash
+        
+        return report
+    
+    def _place_with_employee(self, shift: Shift, employee: Employee, report: Dict) -> bool:
+        """Разместить нераспределенный наряд с участием сотрудника
+        
+        По порядку: напрямую у сотрудника; у сотрудника, перенеся его
+        единственный мешающий наряд другому; у другого сотрудника, которого
+        блокирует ровно один наряд, передав этот наряд сотруднику (без
+        нежелательных дат). Цепочки пробуются в порядке списка сотрудников.
+        """
+        report['iterations'] += 1
+        if self._fits(employee, shift):
+            self._assign_unassigned(shift, employee)
+            return True
+        
+        shift_days = self._get_shift_ordinals(shift)
+        day_shifts = self.employee_stats[employee.id]['day_shifts']
+        blocking = {day_shifts[day] for day in shift_days if day in day_shifts}
+        if len(blocking) == 1:
+            blocking = blocking.pop()
+            if self._fits(employee, shift, released=blocking):
+                target = self._find_relocation(blocking, report)
+                if target is not None:
+                    self._vacate(blocking)
+                    self._occupy(blocking, target)
+                    self._assign_unassigned(shift, employee)
+                    return True
+        
+        for other in self.employees:
+            if other is employee:
+                continue
+            report['iterations'] += 1
+            if not other.vacation_ordinals.isdisjoint(shift_days):
+                continue
+            day_shifts = self.employee_stats[other.id]['day_shifts']
+            blocking = {day_shifts[day] for day in shift_days if day in day_shifts}
+            if len(blocking) != 1:
+                continue
+            blocking = blocking.pop()
+            if (self._fits(other, shift, released=blocking) and
+                    not self._has_exclusion(employee, blocking) and self._fits(employee, blocking)):
+                self._vacate(blocking)
+                self._occupy(blocking, employee)
+                self._assign_unassigned(shift, other)
+                return True
+        return False
+    
+    def _assign_unassigned(self, shift: Shift, employee: Employee):
+        """Назначить наряд из списка нераспределенных"""
+        self.unassigned_shifts.remove(shift)
+        self.unassigned_reasons.pop(shift, None)
+        self._assign_shift(shift, employee)
+    
+    def improve_schedule(self, time_limit: float = 1.0, max_iterations: int = 1_000_000) -> Dict:
+        """Улучшение готового распределения локальным поиском
+        
+        Повторяет, пока есть улучшения и не исчерпан бюджет:
+        1. размещение нераспределенных нарядов (напрямую или с переносом
+           мешающего наряда другому сотруднику);
+        2. перенос нарядов, попавших на нежелательные даты, к свободным сотрудникам
+           (по списку нарушений, который ведется при назначениях);
+        3. выравнивание числа нарядов между сотрудниками с одинаковым приоритетом.
+        Кандидаты перебираются в порядке загрузки (очередь, которая обновляется
+        при каждом ходе), поэтому поиск останавливается на первом подходящем.
+        Неудачная попытка запоминается вместе с состоянием (хэшем назначений)
+        и не повторяется, пока расписание не изменилось; для нераспределенных -
+        по ключу (день, суточный), от которого зависит результат.
+        Бюджет: time_limit секунд или max_iterations проверок (сотрудник × наряд).
+        """
+        started = time.monotonic()
+        deadline = started + time_limit
+        report = {'placed': 0, 'exclusions_fixed': 0, 'balanced': 0, 'iterations': 0, 'elapsed': 0.0}
+        self.clear_history()
+        def within_budget() -> bool:
+            return report['iterations'] < max_iterations and time.monotonic() < deadline
+        
+        # Ключ (день, суточный) -> хэш назначений при неудачной попытке
+        failed_placements = {}
+        self._failed_relocations = {}
+        self._load_order = CandidateQueue(self.employees, self.employee_stats)
+        try:
+            improved = True
+            while improved and within_budget():
+                improved = False
                 
-                # Обновляем статистику
-                self.employee_stats[employee.id]['shifts_count'] += 1
+                # 1. Нераспределенные наряды
+                for shift in list(self.unassigned_shifts):
+                    if not within_budget():
+                        break
+                    key = (shift.day, shift.type in DAILY_SHIFT_TYPES)
+                    if failed_placements.get(key) == self._assignment_hash:
+                        continue
+                    if self._place_unassigned(shift, report):
+                        report['placed'] += 1
+                        improved = True
+                    else:
+                        failed_placements[key] = self._assignment_hash
                 
-                # Отмечаем занятые дни
-                shift_days = self._get_shift_days(shift)
-                self.employee_stats[employee.id]['occupied_days'].update(shift_days)
+                # 2. Нарушения нежелательных дат
+                for shift in list(self._exclusion_violations):
+                    if not within_budget():
+                        break
+                    if shift not in self._exclusion_violations:
+                        continue
+                    target = self._find_relocation(shift, report)
+                    if target:
+                        self._vacate(shift)
+                        self._occupy(shift, target)
+                        report['exclusions_fixed'] += 1
+                        improved = True
                 
-                # Уменьшаем доступные слоты для суточных нарядов
-                if shift.type in [1, 2, 3, 4, 5, 6]:
-                    self.employee_stats[employee.id]['monthly_slots'] -= 1
+                # 3. Выравнивание нагрузки внутри групп одного приоритета
+                while within_budget() and self._balance_step(report, within_budget):
+                    report['balanced'] += 1
+                    improved = True
+        finally:
+            self._load_order = None
+            self._failed_relocations = None
+        
+        report['elapsed'] = time.monotonic() - started
+        return report
+    
+    def _has_exclusion(self, employee: Employee, shift: Shift) -> bool:
+        """Попадает ли наряд на нежелательные даты сотрудника"""
+        return not employee.exclusion_ordinals.isdisjoint(self._get_shift_ordinals(shift))
+    
+    def _fits(self, employee: Employee, shift: Shift, released: Optional[Shift] = None) -> bool:
+        """Может ли сотрудник взять наряд, если с него снять наряд released"""
+        return self._blocker(employee, shift, released) is None
+    
+    def _blocker(self, employee: Employee, shift: Shift, released: Optional[Shift] = None) -> Optional[str]:
+        """Что мешает сотруднику взять наряд: 'vacation', 'limit', 'busy' или None"""
+        if not employee.vacation_ordinals.isdisjoint(self._get_shift_ordinals(shift)):
+            return 'vacation'
+        
+        stats = self.employee_stats[employee.id]
+        if shift.type in DAILY_SHIFT_TYPES:
+            freed_slot = released is not None and released.type in DAILY_SHIFT_TYPES
+            if stats['monthly_slots'] + freed_slot <= 0:
+                return 'limit'
+        
+        occupied_days = stats['occupied_days']
+        released_days = self._get_shift_ordinals(released) if released is not None else ()
+        if any(day in occupied_days and day not in released_days for day in self._get_shift_ordinals(shift)):
+            return 'busy'
+        return None
+    
+    def _employees_by_load(self):
+        """Сотрудники по (-приоритет, число нарядов); в improve_schedule - из очереди загрузки"""
+        if self._load_order is not None:
+            return self._load_order
+        return sorted(self.employees, key=lambda employee: (-employee.priority,
+                                                            self.employee_stats[employee.id]['shifts_count']))
+    
+    def _find_relocation(self, shift: Shift, report: Dict) -> Optional[Employee]:
+        """Найти другого сотрудника без нежелательных дат, который может взять наряд
+        
+        Выбирается первый подходящий в порядке загрузки (наибольший приоритет,
+        затем наименьшее число нарядов). Результат зависит только от дней наряда:
+        исполнитель другого наряда с теми же днями занят в эти дни, поэтому
+        неудача запоминается по ключу (день, суточный) до изменения расписания.
+        """
+        key = (shift.day, shift.type in DAILY_SHIFT_TYPES)
+        failed = self._failed_relocations
+        if failed is not None and failed.get(key) == self._assignment_hash:
+            return None
+        
+        for employee in self._employees_by_load():
+            if employee.id == shift.employee_id:
+                continue
+            report['iterations'] += 1
+            if not self._has_exclusion(employee, shift) and self._fits(employee, shift):
+                return employee
+        
+        if failed is not None:
+            failed[key] = self._assignment_hash
+        return None
+    
+    def _place_unassigned(self, shift: Shift, report: Dict) -> bool:
+        """Разместить нераспределенный наряд напрямую или цепочкой из двух переносов"""
+        shift_days = self._get_shift_ordinals(shift)
+        best = fallback = None
+        ejection_candidates = []
+        
+        # Первый подходящий в порядке загрузки; с нежелательной датой - только если нет других
+        for employee in self._employees_by_load():
+            report['iterations'] += 1
+            if self._fits(employee, shift):
+                if not self._has_exclusion(employee, shift):
+                    best = employee
+                    break
+                if fallback is None:
+                    fallback = employee
+            elif employee.vacation_ordinals.isdisjoint(shift_days):
+                # Сотрудника блокирует ровно один наряд - его можно попробовать перенести
+                day_shifts = self.employee_stats[employee.id]['day_shifts']
+                blocking = {day_shifts[day] for day in shift_days if day in day_shifts}
+                if len(blocking) == 1:
+                    blocking = blocking.pop()
+                    if self._fits(employee, shift, released=blocking):
+                        ejection_candidates.append((employee, blocking))
+        best = best or fallback
+        
+        if best is None:
+            # Цепочки пробуются в порядке списка сотрудников
+            ejection_candidates.sort(key=lambda candidate: candidate[0].id)
+            for employee, blocking in ejection_candidates:
+                target = self._find_relocation(blocking, report)
+                if target is None:
+                    continue
+                self._vacate(blocking)
+                self._occupy(blocking, target)
+                best = employee
+                break
+        
+        if best is None:
+            return False
+        
+        self._assign_unassigned(shift, best)
+        return True
+    
+    def _balance_step(self, report: Dict, within_budget=lambda: True) -> bool:
+        """Перенести один наряд от более загруженного сотрудника к менее загруженному той же группы
+        
+        Группы берутся из очереди загрузки; каждая проверка наряда учитывается в бюджете.
+        """
+        loads = self._load_order or CandidateQueue(self.employees, self.employee_stats)
+        for priority in sorted({employee.priority for employee in self.employees}, reverse=True):
+            members = loads.group(priority)
+            for donor in reversed(members):
+                donor_count = self.employee_stats[donor.id]['shifts_count']
+                for receiver in members:
+                    if donor_count - self.employee_stats[receiver.id]['shifts_count'] < 2:
+                        break
+                    for shift in self.shifts_by_employee[donor.id]:
+                        if not within_budget():
+                            return False
+                        report['iterations'] += 1
+                        if self._has_exclusion(receiver, shift) or not self._fits(receiver, shift):
+                            continue
+                        self._vacate(shift)
+                        self._occupy(shift, receiver)
+                        return True
+        return False
+    
+    def _distribute(self, all_shifts: List[Shift]):
+        """Жадное распределение нарядов по одному"""
+        candidates = CandidateQueue(self.employees, self.employee_stats)
+        
+        for shift in all_shifts:
+            employee = self._select_employee(shift, candidates)
+            
+            if employee:
+                self._assign_shift(shift, employee)
+                candidates.update(employee, self.employee_stats[employee.id]['shifts_count'])
             else:
                 # Нет доступных сотрудников - добавляем в нераспределенные
                 self.unassigned_shifts.append(shift)
+                self.unassigned_reasons[shift] = self._diagnose(shift)
     
-    def _get_shift_days(self, shift: Shift) -> List[datetime]:
-        """Возвращает список дней, которые занимает наряд"""
-        if shift.type in [1, 2, 3, 4, 5, 6]:
-            # Суточный наряд занимает текущий день и следующий
-            return [shift.date, shift.date + timedelta(days=1)]
-        else:
-            # 8-часовой наряд занимает только текущий день
-            return [shift.date]
-    
-    def _get_available_employees(self, shift: Shift) -> List[Employee]:
-        """Поиск сотрудников, доступных для этого наряда"""
-        available = []
-        shift_days = self._get_shift_days(shift)
+    def _distribute_constrained(self, all_shifts: List[Shift]):
+        """Распределение, начиная с наряда с наименьшим числом подходящих сотрудников
         
+        Подходит ли сотрудник, зависит только от дня заступления и того, суточный
+        ли наряд, поэтому счетчики хранятся по ключу (день, суточный), а
+        ожидающие наряды - в очередях по ключам в порядке дат. После назначения
+        пересчитываются только ключи, задевающие дни наряда, и, если у сотрудника
+        закончились слоты, ключи суточных нарядов: O(дней) на назначение.
+        """
+        candidates = CandidateQueue(self.employees, self.employee_stats)
+        num_employees = len(self.employees)
+        
+        # Сколько сотрудников в отпуске в каждый день и два дня подряд
+        on_vacation = defaultdict(int)
+        on_vacation_both = defaultdict(int)
         for employee in self.employees:
-            # 1. Проверка отпуска
-            if any(any(vacation.date() == day.date() for vacation in employee.vacation_days) 
-                   for day in shift_days):
+            for day in employee.vacation_ordinals:
+                on_vacation[day] += 1
+                if day + 1 in employee.vacation_ordinals:
+                    on_vacation_both[day] += 1
+        
+        # Ожидающие наряды по ключу (день, суточный) в порядке дат
+        pending = defaultdict(deque)
+        for index, shift in enumerate(all_shifts):
+            pending[(shift.day, shift.type in DAILY_SHIFT_TYPES)].append(index)
+        
+        eligible_counts = {}
+        for day, is_daily in pending:
+            if is_daily:
+                count = num_employees - on_vacation[day] - on_vacation[day + 1] + on_vacation_both[day]
+            else:
+                count = num_employees - on_vacation[day]
+            eligible_counts[(day, is_daily)] = count
+        pending_daily = {key for key in pending if key[1]}
+        
+        def fits(employee, key):
+            day, is_daily = key
+            days = (day, day + 1) if is_daily else (day,)
+            stats = self.employee_stats[employee.id]
+            return (employee.vacation_ordinals.isdisjoint(days)
+                    and not (is_daily and stats['monthly_slots'] <= 0)
+                    and stats['occupied_days'].isdisjoint(days))
+        
+        # Куча по ключам с ленивым удалением: запись актуальна, пока совпадают счетчик
+        # и первый ожидающий наряд ключа; при равенстве счетчиков раньше идет более ранний наряд
+        heap = [(count, pending[key][0], key) for key, count in eligible_counts.items()]
+        heapq.heapify(heap)
+        
+        while heap:
+            count, index, key = heapq.heappop(heap)
+            queue = pending[key]
+            if not queue or queue[0] != index or count != eligible_counts[key]:
                 continue
+            queue.popleft()
+            if not queue:
+                pending_daily.discard(key)
             
-            # 2. Проверка предпочтительных дат исключения (учитываем, но не блокируем жестко)
-            # Если есть другие доступные сотрудники, пропускаем этого
-            has_preferred_exclusion = any(
-                any(excl.date() == day.date() for excl in employee.preferred_exclusion_days) 
-                for day in shift_days
-            )
+            shift = all_shifts[index]
+            employee = self._select_employee(shift, candidates)
+            if employee is None:
+                self.unassigned_shifts.append(shift)
+                self.unassigned_reasons[shift] = self._diagnose(shift)
+            else:
+                # Ключи, для которых сотрудник может перестать подходить
+                affected = set()
+                for day in self._get_shift_ordinals(shift):
+                    affected.update(((day, False), (day, True), (day - 1, True)))
+                if key[1] and self.employee_stats[employee.id]['monthly_slots'] == 1:
+                    affected |= pending_daily
+                was_eligible = [other for other in affected if pending.get(other) and fits(employee, other)]
+                
+                self._assign_shift(shift, employee)
+                candidates.update(employee, self.employee_stats[employee.id]['shifts_count'])
+                
+                for other in was_eligible:
+                    if not fits(employee, other):
+                        eligible_counts[other] -= 1
+                        if other != key:
+                            heapq.heappush(heap, (eligible_counts[other], pending[other][0], other))
             
-            # 3. Проверка лимита суточных нарядов (15 в месяц)
-            if shift.type in [1, 2, 3, 4, 5, 6] and self.employee_stats[employee.id]['monthly_slots'] <= 0:
+            if queue:
+                heapq.heappush(heap, (eligible_counts[key], queue[0], key))
+        
+        # Результаты в порядке дат, как и в остальных режимах
+        self.assigned_shifts.sort(key=lambda x: x.day)
+        self.unassigned_shifts.sort(key=lambda x: x.day)
+    
+    def _select_employee(self, shift: Shift, candidates: CandidateQueue) -> Optional[Employee]:
+        """Выбор сотрудника для наряда: первый доступный в порядке очереди
+        
+        Сотрудники с нежелательной датой выбираются, только если нет других доступных.
+        """
+        shift_ordinals = self._get_shift_ordinals(shift)
+        is_daily = shift.type in DAILY_SHIFT_TYPES
+        fallback = None
+        
+        for employee in candidates:
+            if not employee.vacation_ordinals.isdisjoint(shift_ordinals):
+                continue
+            
+            stats = self.employee_stats[employee.id]
+            if is_daily and stats['monthly_slots'] <= 0:
+                continue
+            
+            if not stats['occupied_days'].isdisjoint(shift_ordinals):
                 continue
             
-            # 4. Проверка что сотрудник не занят в эти дни другими нарядами
-            if any(day in self.employee_stats[employee.id]['occupied_days'] for day in shift_days):
+            if employee.exclusion_ordinals.isdisjoint(shift_ordinals):
+                return employee
+            
+            if fallback is None:
+                fallback = employee
+        
+        return fallback
+    
+    def _distribute_vectorized(self, all_shifts: List[Shift]):
+        """Жадное распределение на матрицах numpy (тот же порядок выбора, что и в _distribute)"""
+        if not all_shifts:
+            return
+        if not self.employees:
+            for shift in all_shifts:
+                self.unassigned_shifts.append(shift)
+                self.unassigned_reasons[shift] = self._diagnose(shift)
+            return
+        
+        first_day = all_shifts[0].day
+        num_days = all_shifts[-1].day - first_day + 2
+        num_employees = len(self.employees)
+        
+        vacation, exclusion = self._day_masks(first_day, num_days)
+        occupied = np.zeros((num_days, num_employees), dtype=bool)
+        
+        monthly_slots = np.full(num_employees, 15, dtype=np.int64)
+        priority = np.array([employee.priority for employee in self.employees], dtype=np.int64)
+        
+        # Ключ сортировки (-приоритет, число нарядов) в одном целом числе;
+        # argmin возвращает первый минимум, что совпадает с устойчивой сортировкой
+        weight = len(all_shifts) + 1
+        sort_key = (priority.max() - priority) * weight
+        unavailable = np.iinfo(np.int64).max
+        
+        for shift in all_shifts:
+            row = shift.day - first_day
+            is_daily = shift.type in DAILY_SHIFT_TYPES
+            
+            if is_daily:
+                on_vacation = vacation[row] | vacation[row + 1]
+                busy = occupied[row] | occupied[row + 1]
+                at_limit = monthly_slots <= 0
+                excluded = exclusion[row] | exclusion[row + 1]
+            else:
+                on_vacation = vacation[row]
+                busy = occupied[row]
+                at_limit = np.zeros(num_employees, dtype=bool)
+                excluded = exclusion[row]
+            
+            candidates = ~(on_vacation | busy | at_limit)
+            if not candidates.any():
+                self.unassigned_shifts.append(shift)
+                available = ~on_vacation
+                self.unassigned_reasons[shift] = self._build_diagnosis(
+                    shift,
+                    vacation=int(on_vacation.sum()),
+                    limit=int((available & at_limit).sum()),
+                    busy=int((available & ~at_limit & busy).sum()),
+                    busy_available=int((available & busy).sum()),
+                    exclusion=int(excluded.sum())
+                )
                 continue
             
-            # Добавляем в список, отмечая предпочтения
-            available.append((employee, has_preferred_exclusion))
+            # Сотрудники без нежелательных дат имеют преимущество
+            preferred = candidates & ~excluded
+            if preferred.any():
+                candidates = preferred
+            
+            col = int(np.argmin(np.where(candidates, sort_key, unavailable)))
+            
+            occupied[row, col] = True
+            if is_daily:
+                occupied[row + 1, col] = True
+                monthly_slots[col] -= 1
+            sort_key[col] += 1
+            
+            self._assign_shift(shift, self.employees[col])
+    
+    def _day_masks(self, first_day: int, num_days: int):
+        """Матрицы день × сотрудник (отпуск, нежелательные даты); строка дня лежит в памяти непрерывно"""
+        vacation = np.zeros((num_days, len(self.employees)), dtype=bool)
+        exclusion = np.zeros((num_days, len(self.employees)), dtype=bool)
+        for col, employee in enumerate(self.employees):
+            rows = [day - first_day for day in employee.vacation_ordinals if 0 <= day - first_day < num_days]
+            vacation[rows, col] = True
+            rows = [day - first_day for day in employee.exclusion_ordinals if 0 <= day - first_day < num_days]
+            exclusion[rows, col] = True
+        return vacation, exclusion
+    
+    def _assign_shift(self, shift: Shift, employee: Employee):
+        """Назначить наряд сотруднику и обновить статистику"""
+        self.assigned_shifts.append(shift)
+        self._occupy(shift, employee)
+    
+    def _occupy(self, shift: Shift, employee: Employee):
+        """Закрепить наряд за сотрудником в статистике и индексах"""
+        shift.employee_id = employee.id
+        self.shifts_by_employee[employee.id].append(shift)
+        self._assignment_hash ^= hash((shift.day, shift.type, employee.id))
+        
+        stats = self.employee_stats[employee.id]
+        stats['shifts_count'] += 1
+        
+        # Отмечаем занятые дни
+        shift_ordinals = self._get_shift_ordinals(shift)
+        stats['occupied_days'].update(shift_ordinals)
+        for day in shift_ordinals:
+            stats['day_shifts'][day] = shift
+        
+        # Уменьшаем доступные слоты для суточных нарядов
+        if shift.type in DAILY_SHIFT_TYPES:
+            stats['monthly_slots'] -= 1
         
-        # Сначала пытаемся выбрать тех, у кого нет предпочтений исключения
-        preferred_available = [emp for emp, has_excl in available if not has_excl]
-        if preferred_available:
-            return preferred_available
+        if not employee.exclusion_ordinals.isdisjoint(shift_ordinals):
+            self._exclusion_violations[shift] = None
+        if self._load_order is not None:
+            self._load_order.update(employee, stats['shifts_count'])
+    
+    def _vacate(self, shift: Shift):
+        """Снять наряд с сотрудника в статистике и индексах (обратно _occupy)"""
+        self.shifts_by_employee[shift.employee_id].remove(shift)
+        self._assignment_hash ^= hash((shift.day, shift.type, shift.employee_id))
+        
+        stats = self.employee_stats[shift.employee_id]
+        stats['shifts_count'] -= 1
+        shift_ordinals = self._get_shift_ordinals(shift)
+        stats['occupied_days'].difference_update(shift_ordinals)
+        for day in shift_ordinals:
+            del stats['day_shifts'][day]
+        if shift.type in DAILY_SHIFT_TYPES:
+            stats['monthly_slots'] += 1
         
-        # Если таких нет, возвращаем всех доступных
-        return [emp for emp, _ in available]
+        self._exclusion_violations.pop(shift, None)
+        if self._load_order is not None:
+            self._load_order.update(self.employee_by_id[shift.employee_id], stats['shifts_count'])
+        
+        shift.employee_id = None
+    
+    def _get_shift_ordinals(self, shift: Shift) -> List[int]:
+        """Возвращает порядковые номера дней, которые занимает наряд"""
+        if shift.type in DAILY_SHIFT_TYPES:
+            return [shift.day, shift.day + 1]
+        return [shift.day]
 
+    def check_feasibility(self, daily_shifts: Dict[datetime, List[int]]) -> Dict:
+        """Быстрая оценка выполнимости до генерации (без распределения)
+        
+        Для каждого дня сравнивается число сотрудников не в отпуске с числом
+        занятых мест (суточный наряд занимает день заступления и следующий).
+        Дополнительно проверяются суточные наряды, для которых не хватает
+        сотрудников, свободных два дня подряд, и общий бюджет слотов (15 на
+        сотрудника). min_unassigned - нижняя оценка числа нераспределенных
+        нарядов при любом распределении.
+        """
+        report = {
+            'days': [],
+            'short_days': [],
+            'total_shifts': sum(len(shift_types) for shift_types in daily_shifts.values()),
+            'slot_demand': 0,
+            'slot_capacity': 15 * len(self.employees),
+            'slot_shortage': 0,
+            'min_unassigned': 0
+        }
+        dates = [date for date, shift_types in daily_shifts.items() if shift_types]
+        if not dates:
+            return report
+        
+        first_day = min(dates).toordinal()
+        num_days = max(dates).toordinal() - first_day + 2
+        num_employees = len(self.employees)
+        
+        daily_rows, short_rows = [], []
+        for date, shift_types in daily_shifts.items():
+            row = date.toordinal() - first_day
+            for shift_type in shift_types:
+                (daily_rows if shift_type in DAILY_SHIFT_TYPES else short_rows).append(row)
+        
+        vacation_rows, vacation_pair_rows = [], []
+        for employee in self.employees:
+            employee.build_day_index()
+            for day in employee.vacation_ordinals:
+                row = day - first_day
+                if 0 <= row < num_days:
+                    vacation_rows.append(row)
+                    if day + 1 in employee.vacation_ordinals:
+                        vacation_pair_rows.append(row)
+        
+        if np is not None:
+            daily_starts = np.bincount(daily_rows, minlength=num_days)
+            demand = daily_starts + np.bincount(short_rows, minlength=num_days)
+            demand[1:] += daily_starts[:-1]
+            on_vacation = np.bincount(vacation_rows, minlength=num_days)
+            on_vacation_both = np.bincount(vacation_pair_rows, minlength=num_days)
+            supply = num_employees - on_vacation
+            # Сотрудники, свободные от отпуска в день заступления и на следующий день
+            supply_pair = supply.copy()
+            supply_pair[:-1] -= on_vacation[1:] - on_vacation_both[:-1]
+            shortage = np.maximum(demand - supply, 0)
+            start_shortage = np.maximum(daily_starts - supply_pair, 0)
+            daily_starts, demand, supply, shortage, start_shortage = (
+                daily_starts.tolist(), demand.tolist(), supply.tolist(),
+                shortage.tolist(), start_shortage.tolist()
+            )
+        else:
+            daily_starts = [0] * num_days
+            demand = [0] * num_days
+            on_vacation = [0] * num_days
+            on_vacation_both = [0] * num_days
+            for row in daily_rows:
+                daily_starts[row] += 1
+                demand[row] += 1
+                demand[row + 1] += 1
+            for row in short_rows:
+                demand[row] += 1
+            for row in vacation_rows:
+                on_vacation[row] += 1
+            for row in vacation_pair_rows:
+                on_vacation_both[row] += 1
+            supply = [num_employees - count for count in on_vacation]
+            supply_pair = [
+                supply[row] - (on_vacation[row + 1] - on_vacation_both[row] if row + 1 < num_days else 0)
+                for row in range(num_days)
+            ]
+            shortage = [max(demand[row] - supply[row], 0) for row in range(num_days)]
+            start_shortage = [max(daily_starts[row] - supply_pair[row], 0) for row in range(num_days)]
+        
+        for row in range(num_days):
+            date = datetime.fromordinal(first_day + row)
+            report['days'].append({
+                'date': date,
+                'supply': supply[row],
+                'demand': demand[row],
+                'shortage': max(shortage[row], start_shortage[row])
+            })
+            if shortage[row] or start_shortage[row]:
+                report['short_days'].append(date)
+        
+        report['slot_demand'] = len(daily_rows)
+        report['slot_shortage'] = max(report['slot_demand'] - report['slot_capacity'], 0)
+        
+        # Наряд занимает не более одного четного и одного нечетного дня, поэтому
+        # дефициты четных (и отдельно нечетных) дней складываются
+        report['min_unassigned'] = max(
+            sum(shortage[0::2]),
+            sum(shortage[1::2]),
+            sum(start_shortage),
+            report['slot_shortage']
+        )
+        return report
+    
     def analyze_unassigned_reason(self, shift: Shift) -> str:
-        """Анализирует причину нераспределенного наряда"""
-        shift_days = self._get_shift_days(shift)
-        
-        # Проверяем, есть ли вообще сотрудники не в отпуске в эти дни
-        available_employees = []
-        for emp in self.employees:
-            if not any(any(vac.date() == day.date() for vac in emp.vacation_days) for day in shift_days):
-                available_employees.append(emp)
-        
-        if not available_employees:
-            return "Все сотрудники в отпуске"
-        
-        # Проверяем лимит суточных нарядов
-        if shift.type in [1, 2, 3, 4, 5, 6]:
-            overloaded_count = 0
-            for emp in available_employees:
-                if self.employee_stats[emp.id]['monthly_slots'] <= 0:
-                    overloaded_count += 1
+        """Анализирует причину нераспределенного наряда по текущему состоянию"""
+        return self._diagnose(shift)['reason']
+    
+    def get_unassigned_reason(self, shift: Shift) -> str:
+        """Причина нераспределенного наряда, зафиксированная при распределении"""
+        diagnosis = self.unassigned_reasons.get(shift)
+        if diagnosis is None:
+            return self.analyze_unassigned_reason(shift)
+        return diagnosis['reason']
+    
+    def _diagnose(self, shift: Shift) -> Dict:
+        """Подсчет сотрудников, которым мешает каждое ограничение, за один проход
+        
+        Каждый сотрудник учитывается по первому ограничению: отпуск, лимит
+        суточных нарядов, занятость. exclusion - сколько сотрудников имеют
+        нежелательную дату на эти дни (мягкое ограничение).
+        """
+        shift_ordinals = self._get_shift_ordinals(shift)
+        is_daily = shift.type in DAILY_SHIFT_TYPES
+        counts = {'vacation': 0, 'limit': 0, 'busy': 0, 'busy_available': 0, 'exclusion': 0}
+        
+        for employee in self.employees:
+            if not employee.exclusion_ordinals.isdisjoint(shift_ordinals):
+                counts['exclusion'] += 1
+            if not employee.vacation_ordinals.isdisjoint(shift_ordinals):
+                counts['vacation'] += 1
+                continue
             
-            if overloaded_count == len(available_employees):
-                return "Все доступные достигли лимита (15 нарядов)"
+            stats = self.employee_stats[employee.id]
+            at_limit = is_daily and stats['monthly_slots'] <= 0
+            busy = not stats['occupied_days'].isdisjoint(shift_ordinals)
+            if busy:
+                counts['busy_available'] += 1
+            if at_limit:
+                counts['limit'] += 1
+            elif busy:
+                counts['busy'] += 1
         
-        # Проверяем занятость
-        busy_count = 0
-        for emp in available_employees:
-            if any(day in self.employee_stats[emp.id]['occupied_days'] for day in shift_days):
-                busy_count += 1
+        return self._build_diagnosis(shift, **counts)
+    
+    def _build_diagnosis(self, shift: Shift, vacation: int, limit: int, busy: int,
+                         busy_available: int, exclusion: int) -> Dict:
+        """Причина нераспределения по числу заблокированных сотрудников
         
-        if busy_count == len(available_employees):
-            return "Все доступные заняты в эти дни"
+        busy_available - занятые среди сотрудников не в отпуске (включая
+        достигших лимита), по нему определяется причина "заняты".
+        """
+        available = len(self.employees) - vacation
         
-        return "Недостаточно сотрудников"
+        if not available:
+            reason = "Все сотрудники в отпуске"
+        elif shift.type in DAILY_SHIFT_TYPES and limit == available:
+            reason = "Все доступные достигли лимита (15 нарядов)"
+        elif busy_available == available:
+            reason = "Все доступные заняты в эти дни"
+        else:
+            reason = "Недостаточно сотрудников"
+        
+        return {
+            'reason': reason,
+            'vacation': vacation,
+            'limit': limit,
+            'busy': busy,
+            'exclusion': exclusion
+        }
 
     def get_statistics(self) -> Dict:
         """Получить статистику распределения"""
@@ -188,10 +1562,9 @@ class ShiftScheduler:
         }
         
         for employee in self.employees:
-            employee_shifts = [s for s in self.assigned_shifts if s.employee_id == employee.id]
             stats['employee_loads'].append({
                 'name': employee.name,
-                'shifts': len(employee_shifts),
+                'shifts': len(self.shifts_by_employee[employee.id]),
                 'remaining_slots': self.employee_stats[employee.id]['monthly_slots']
             })
         
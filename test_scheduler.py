@@ -0,0 +1,42 @@
+import random
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from scheduler import ShiftScheduler
+
+pytest.importorskip("scipy")
+
+
+def make_scheduler(num_employees: int, num_days: int = 180, shifts_per_day: int = 36, seed: int = 1):
+    """Планировщик со случайными отпусками и нарядами (перегруженный: часть нарядов не распределяется)"""
+    rnd = random.Random(seed)
+    start = datetime(2025, 1, 1)
+    scheduler = ShiftScheduler()
+    for i in range(num_employees):
+        vacation_start = rnd.randrange(num_days)
+        vacation = [start + timedelta(days=vacation_start + k) for k in range(rnd.choice([0, 7, 14]))]
+        exclusion = [start + timedelta(days=rnd.randrange(num_days)) for _ in range(3)]
+        scheduler.add_employee(f"Сотрудник {i}", vacation, exclusion, rnd.randrange(3))
+    daily_shifts = {
+        start + timedelta(days=d): [rnd.randint(1, 7) for _ in range(shifts_per_day)]
+        for d in range(num_days)
+    }
+    return scheduler, daily_shifts
+
+
+@pytest.mark.parametrize("num_employees", [100, 300])
+def test_optimal_schedule_respects_time_limit(num_employees):
+    # 100 сотрудников - около 620 тыс. переменных (решатель запускается),
+    # 300 - около 1,9 млн (модель не строится)
+    scheduler, daily_shifts = make_scheduler(num_employees)
+    time_limit = 10.0
+
+    started = time.monotonic()
+    report = scheduler.generate_optimal_schedule(daily_shifts, time_limit=time_limit)
+    elapsed = time.monotonic() - started
+
+    assert elapsed < time_limit + 1.5
+    assert report['unassigned'] <= report['greedy_unassigned']
+    assert len(scheduler.unassigned_shifts) == report['unassigned']
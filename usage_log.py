@@ -0,0 +1,194 @@
+import atexit
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+# Запись журнала: license_key, session_id, action, timestamp (ISO 8601)
+UsageRecord = Tuple[Optional[str], Optional[str], str, str]
+
+
+def create_usage_schema(cursor):
+    """Таблицы журнала использования: сырые записи, дневные итоги и индексы
+
+    Дневные итоги (usage_daily) при первом создании заполняются по уже
+    накопленным записям usage_logs.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS usage_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            license_key TEXT,
+            session_id TEXT,
+            action TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_logs_timestamp ON usage_logs (timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_logs_license ON usage_logs (license_key, timestamp)")
+
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'usage_daily'")
+    rollup_exists = cursor.fetchone() is not None
+    # license_key = '' - действия без лицензии (демо-сессии)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            day TEXT NOT NULL,
+            license_key TEXT NOT NULL DEFAULT '',
+            action TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, license_key, action)
+        )
+    """)
+    if not rollup_exists:
+        cursor.execute("""
+            INSERT INTO usage_daily (day, license_key, action, count)
+            SELECT substr(timestamp, 1, 10), COALESCE(license_key, ''), action, COUNT(*)
+            FROM usage_logs
+            GROUP BY 1, 2, 3
+        """)
+
+
+class UsageLogWriter:
+    """Фоновая запись журнала использования
+
+    log() только ставит запись в очередь. Поток-писатель раз в flush_interval
+    секунд (или раньше, если накопилось batch_size записей) сохраняет очередь
+    пачками через executemany и в той же транзакции обновляет дневные итоги.
+    Сырые записи старше retention_days удаляются раз в prune_interval секунд
+    (итоги хранятся без ограничения). При завершении процесса очередь
+    сохраняется (atexit).
+    """
+
+    # Сколько несохраненных записей держать для повтора при ошибках базы
+    MAX_PENDING = 10000
+
+    def __init__(self, connect: Callable, flush_interval: float = 2.0, batch_size: int = 500,
+                 retention_days: Optional[int] = 90, prune_interval: float = 3600):
+        if flush_interval <= 0 or batch_size < 1:
+            raise ValueError("Интервал записи и размер пачки должны быть положительными")
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retention_days = retention_days
+        self.prune_interval = prune_interval
+        self.written = 0
+        self.pruned = 0
+        self.last_error: Optional[str] = None
+        self._connect = connect
+        self._queue: "queue.Queue" = queue.Queue()
+        self._pending: List[UsageRecord] = []
+        # Маркеры flush(), ожидающие записи всех поставленных до них записей
+        self._markers: List[threading.Event] = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="usage-log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, action: str, license_key: Optional[str] = None, session_id: Optional[str] = None,
+            timestamp: Optional[datetime] = None):
+        """Поставить запись в очередь (не ждет записи в базу)"""
+        self._queue.put((license_key, session_id, action, (timestamp or datetime.now()).isoformat()))
+        if self._queue.qsize() >= self.batch_size:
+            self._wake.set()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Дождаться записи всего, что поставлено в очередь до вызова
+
+        False - не дождались: истек timeout или база недоступна (ошибка в last_error).
+        """
+        if not self._thread.is_alive():
+            return self._queue.empty() and not self._pending
+        marker = threading.Event()
+        self._queue.put(marker)
+        self._wake.set()
+        return marker.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10):
+        """Сохранить очередь и остановить поток"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        atexit.unregister(self.close)
+
+    def _run(self):
+        conn = self._connect()
+        next_prune = time.monotonic()
+        try:
+            while True:
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                stopping = self._stop.is_set()
+
+                self._write_pending(conn)
+                if self.retention_days is not None and time.monotonic() >= next_prune:
+                    self._prune(conn)
+                    next_prune = time.monotonic() + self.prune_interval
+
+                if stopping:
+                    break
+        finally:
+            conn.close()
+
+    def _write_pending(self, conn):
+        """Сохранить очередь пачками
+
+        Маркеры flush() отмечаются только когда все записи сохранены;
+        при ошибке базы они ждут следующей успешной записи.
+        """
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, threading.Event):
+                self._markers.append(item)
+            else:
+                self._pending.append(item)
+
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            try:
+                self._write_batch(conn, batch)
+            except Exception as e:
+                # База занята или недоступна: повторим в следующий раз, самые старые записи сверх лимита теряются
+                self.last_error = str(e)
+                del self._pending[:max(len(self._pending) - self.MAX_PENDING, 0)]
+                break
+            del self._pending[:len(batch)]
+            self.written += len(batch)
+
+        if not self._pending:
+            for marker in self._markers:
+                marker.set()
+            self._markers.clear()
+
+    def _write_batch(self, conn, batch: List[UsageRecord]):
+        rollup = Counter((timestamp[:10], license_key or '', action)
+                         for license_key, _, action, timestamp in batch)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("""
+                INSERT INTO usage_logs
+                (license_key, session_id, action, timestamp)
+                VALUES (?, ?, ?, ?)
+            """, batch)
+            conn.executemany("""
+                INSERT INTO usage_daily (day, license_key, action, count)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (day, license_key, action) DO UPDATE SET count = count + excluded.count
+            """, [(day, license_key, action, count) for (day, license_key, action), count in rollup.items()])
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def _prune(self, conn):
+        """Удалить сырые записи старше срока хранения (по индексу timestamp)"""
+        cutoff = (datetime.now() - timedelta(days=self.retention_days)).isoformat()
+        try:
+            self.pruned += conn.execute("DELETE FROM usage_logs WHERE timestamp < ?", (cutoff,)).rowcount
+        except Exception as e:
+            self.last_error = str(e)